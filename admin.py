@@ -3,11 +3,15 @@ from google import genai
 from google.genai import types
 import time
 import os
-import tempfile
+import io
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import hashlib
 import json
 from datetime import datetime
+from shared_client import get_client
 
 # 頁面配置
 st.set_page_config(
@@ -17,16 +21,8 @@ st.set_page_config(
 )
 
 # 初始化客戶端
-@st.cache_resource
-def init_client():
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        st.error("請設定 GEMINI_API_KEY 環境變數")
-        st.stop()
-    return genai.Client(api_key=api_key)
-
 try:
-    client = init_client()
+    client = get_client()
 except Exception as e:
     st.error(f"初始化客戶端失敗: {str(e)}")
     st.info("請確認已正確設定 GEMINI_API_KEY 環境變數")
@@ -35,13 +31,16 @@ except Exception as e:
 # 檔案註冊表管理
 REGISTRY_FILE = "file_registry.json"
 
+# 允許上傳的檔案格式 (保持順序供上傳元件顯示)
+ALLOWED_FILE_TYPES = ('txt', 'pdf', 'docx', 'xlsx', 'pptx', 'md', 'html', 'json', 'csv')
+
 def load_registry():
     """載入檔案註冊表"""
     if os.path.exists(REGISTRY_FILE):
         try:
             with open(REGISTRY_FILE, 'r', encoding='utf-8') as f:
                 return json.load(f)
-        except:
+        except (OSError, ValueError):
             return {}
     return {}
 
@@ -87,6 +86,107 @@ def register_file(file_name, file_hash, store_name, file_id=None):
     save_registry(registry)
     return registry[key]
 
+# 部分平台的 mimetypes 不認得以下格式
+mimetypes.add_type('text/markdown', '.md')
+mimetypes.add_type('application/vnd.openxmlformats-officedocument.wordprocessingml.document', '.docx')
+mimetypes.add_type('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', '.xlsx')
+mimetypes.add_type('application/vnd.openxmlformats-officedocument.presentationml.presentation', '.pptx')
+
+# 上傳工作執行緒
+thread_local = threading.local()
+
+def get_thread_client():
+    """取得目前執行緒專用的客戶端 (SDK 的 HTTP session 不保證執行緒安全)"""
+    if not hasattr(thread_local, 'client'):
+        thread_local.client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return thread_local.client
+
+def wait_for_operation(worker_client, operation):
+    """以指數退避輪詢,等待操作完成"""
+    # 小檔案通常在 1 秒內完成,從短間隔開始輪詢
+    delay = 0.25
+    while not operation.done:
+        time.sleep(delay)
+        operation = worker_client.operations.get(operation)
+        delay = min(delay * 1.5, 4.0)
+    return operation
+
+def upload_single_file(file_content, file_name, display_name, store_name,
+                       upload_method, upload_config, import_config):
+    """上傳單一檔案並等待處理完成 (在工作執行緒中執行,不可呼叫 st.*)
+    Returns: 已完成的 operation
+    """
+    worker_client = get_thread_client()
+    
+    # 直接從記憶體上傳,不經過臨時檔案 (SDK 需要明確指定 mime_type)
+    mime_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    
+    # 緩衝區只在上傳期間需要,等待處理完成前即釋放
+    with io.BytesIO(file_content) as file_buffer:
+        if upload_method == "直接上傳":
+            config = dict(upload_config, display_name=display_name, mime_type=mime_type)
+            operation = worker_client.file_search_stores.upload_to_file_search_store(
+                file=file_buffer,
+                file_search_store_name=store_name,
+                config=config
+            )
+        else:
+            # 先上傳到 Files API
+            sample_file = worker_client.files.upload(
+                file=file_buffer,
+                config={'display_name': display_name, 'mime_type': mime_type}
+            )
+            
+            # 匯入到商店
+            operation = worker_client.file_search_stores.import_file(
+                file_search_store_name=store_name,
+                file_name=sample_file.name,
+                **import_config
+            )
+    
+    return wait_for_operation(worker_client, operation)
+
+def delete_store(store_name):
+    """刪除單一商店 (在工作執行緒中執行,不可呼叫 st.*)
+    Returns: 失敗時的錯誤訊息,成功時為 None
+    """
+    try:
+        get_thread_client().file_search_stores.delete(
+            name=store_name,
+            config={'force': True}
+        )
+        return None
+    except Exception as e:
+        return str(e)
+
+def format_create_time(create_time):
+    """格式化商店建立時間 (可能是 datetime 物件或字串)"""
+    if not create_time:
+        return "未知"
+    if hasattr(create_time, 'strftime'):
+        return create_time.strftime('%Y-%m-%d')
+    return str(create_time)[:10]
+
+# 商店列表 (快取 5 分鐘,其他管道建立/刪除的商店最晚 5 分鐘後出現;本頁操作後會主動清除快取)
+@st.cache_data(ttl=300, show_spinner=False)
+def get_stores():
+    return [
+        {
+            "name": store.name,
+            "display_name": store.display_name or "未命名",
+            "create_time": format_create_time(getattr(store, 'create_time', None))
+        }
+        for store in client.file_search_stores.list()
+    ]
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_store_options():
+    """商店顯示名稱 → 商店 ID 對照表
+    Returns: (store_options, stores)
+    """
+    stores = get_stores()
+    return {s["display_name"]: s["name"] for s in stores}, stores
+
 st.title("🗄️ 檔案搜尋商店管理系統")
 st.markdown("管理您的知識庫和法規文件")
 
@@ -97,11 +197,15 @@ if registry:
 
 st.markdown("---")
 
+# 取得商店列表 (各標籤頁共用)
+store_options, stores = get_store_options()
+
 # 標籤頁
 tab1, tab2, tab3, tab4 = st.tabs(["📁 商店管理", "⬆️ 上傳檔案", "📊 統計資訊", "🔄 版本控制"])
 
 # ===== 標籤頁 1: 商店管理 =====
-with tab1:
+@st.fragment
+def render_store_tab():
     st.header("管理檔案搜尋商店")
     
     col1, col2 = st.columns([2, 1])
@@ -123,6 +227,7 @@ with tab1:
                         )
                         st.success(f"✅ 成功建立商店: {new_store_name}")
                         st.info(f"商店 ID: `{store.name}`")
+                        st.cache_data.clear()
                         time.sleep(1)
                         st.rerun()
                     except Exception as e:
@@ -139,28 +244,36 @@ with tab1:
     # 顯示現有商店
     st.subheader("現有商店列表")
     
-    @st.cache_data(ttl=30)
-    def get_stores():
-        stores = []
-        for store in client.file_search_stores.list():
-            create_time = getattr(store, 'create_time', None)
-            # 處理 datetime 物件
-            if create_time:
-                if hasattr(create_time, 'strftime'):
-                    create_time_str = create_time.strftime('%Y-%m-%d')
-                else:
-                    create_time_str = str(create_time)[:10]
-            else:
-                create_time_str = "未知"
-            
-            stores.append({
-                "name": store.name,
-                "display_name": store.display_name or "未命名",
-                "create_time": create_time_str
-            })
-        return stores
+    # 待刪除的商店 (標記後一次確認,批次並行刪除)
+    if 'pending_deletes' not in st.session_state:
+        st.session_state.pending_deletes = []
+    pending_deletes = st.session_state.pending_deletes
     
-    stores = get_stores()
+    if pending_deletes:
+        st.warning(f"⚠️ 已標記 {len(pending_deletes)} 個商店待刪除")
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("🗑️ 確認刪除", type="primary", use_container_width=True):
+                with st.spinner("正在刪除商店..."):
+                    with ThreadPoolExecutor(max_workers=8) as executor:
+                        errors = dict(zip(pending_deletes, executor.map(delete_store, pending_deletes)))
+                
+                failed = [name for name, error in errors.items() if error]
+                st.session_state.pending_deletes = failed
+                st.cache_data.clear()
+                
+                if failed:
+                    display_names = {s['name']: s['display_name'] for s in stores}
+                    for name in failed:
+                        st.error(f"刪除失敗: {display_names.get(name, name)} ({errors[name]})")
+                else:
+                    st.success(f"已刪除 {len(errors)} 個商店")
+                    time.sleep(1)
+                    st.rerun()
+        with col2:
+            if st.button("取消", key="cancel_deletes", use_container_width=True):
+                st.session_state.pending_deletes = []
+                st.rerun(scope="fragment")
     
     if not stores:
         st.info("目前沒有任何商店,請建立一個新商店")
@@ -180,33 +293,30 @@ with tab1:
                         st.caption("建立時間: 未知")
                 
                 with col3:
-                    delete_key = f"delete_{store['name']}"
-                    if st.button("🗑️ 刪除", key=delete_key, type="secondary"):
-                        try:
-                            client.file_search_stores.delete(
-                                name=store['name'],
-                                config={'force': True}
-                            )
-                            st.success(f"已刪除商店: {store['display_name']}")
-                            st.cache_data.clear()
-                            time.sleep(1)
-                            st.rerun()
-                        except Exception as e:
-                            st.error(f"刪除失敗: {str(e)}")
+                    if store['name'] in pending_deletes:
+                        if st.button("↩️ 取消刪除", key=f"undo_delete_{store['name']}"):
+                            pending_deletes.remove(store['name'])
+                            st.rerun(scope="fragment")
+                    else:
+                        delete_key = f"delete_{store['name']}"
+                        if st.button("🗑️ 刪除", key=delete_key, type="secondary"):
+                            pending_deletes.append(store['name'])
+                            st.rerun(scope="fragment")
                 
                 st.divider()
 
+with tab1:
+    render_store_tab()
+
 # ===== 標籤頁 2: 上傳檔案 =====
-with tab2:
+@st.fragment
+def render_upload_tab():
     st.header("上傳檔案到商店")
     
     # 選擇目標商店
-    stores = get_stores()
-    
     if not stores:
         st.warning("⚠️ 請先建立一個商店")
     else:
-        store_options = {s["display_name"]: s["name"] for s in stores}
         selected_display = st.selectbox(
             "選擇目標商店",
             options=list(store_options.keys())
@@ -226,7 +336,7 @@ with tab2:
         uploaded_files = st.file_uploader(
             "選擇檔案",
             accept_multiple_files=True,
-            type=['txt', 'pdf', 'docx', 'xlsx', 'pptx', 'md', 'html', 'json', 'csv']
+            type=ALLOWED_FILE_TYPES
         )
         
         # 進階設定
@@ -257,6 +367,12 @@ with tab2:
                         metadata_items.append({"key": "category", "string_value": category})
                     if document_version:
                         metadata_items.append({"key": "document_version", "string_value": document_version})
+            
+            max_workers = st.slider(
+                "同時上傳檔案數",
+                1, 8, 4,
+                help="同時進行上傳的檔案數量,過高可能觸發 API 速率限制"
+            )
         
         # 上傳按鈕
         if st.button("🚀 開始上傳", type="primary", use_container_width=True):
@@ -270,118 +386,116 @@ with tab2:
                 success_count = 0
                 skipped_count = 0
                 updated_count = 0
+                completed_count = 0
+                
+                # 準備上傳設定
+                upload_config = {}
+                if use_custom_chunking:
+                    upload_config['chunking_config'] = {
+                        'white_space_config': {
+                            'max_tokens_per_chunk': max_tokens,
+                            'max_overlap_tokens': overlap_tokens
+                        }
+                    }
+                if metadata_items:
+                    upload_config['custom_metadata'] = metadata_items
+                
+                # 準備匯入設定
+                import_config = {}
+                if metadata_items:
+                    import_config['custom_metadata'] = metadata_items
                 
-                for idx, uploaded_file in enumerate(uploaded_files):
-                    status_text.text(f"正在處理: {uploaded_file.name} ({idx+1}/{total_files})")
+                # 各檔案處理結果,於全部完成後一次顯示: (檔名, 狀態, 說明)
+                results = []
+                
+                # 檢查檔案狀態 (在主執行緒完成,避免多個執行緒同時寫入註冊表)
+                pending_files = []
+                for uploaded_file in uploaded_files:
+                    file_content = uploaded_file.getvalue()
                     
-                    try:
-                        # 建立臨時檔案 (跨平台相容)
-                        file_content = uploaded_file.getbuffer()
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
-                            tmp_file.write(file_content)
-                            temp_path = tmp_file.name
-                        
-                        # 計算檔案 hash
-                        file_hash = calculate_file_hash(file_content)
-                        
-                        # 檢查檔案狀態
-                        file_status, old_info = check_file_status(uploaded_file.name, file_hash, selected_store)
-                        
-                        # 處理檔案名稱長度限制 (40 字元)
-                        original_name = uploaded_file.name
-                        display_name = original_name
-                        if len(display_name) > 40:
-                            name_part, ext = os.path.splitext(display_name)
-                            max_name_len = 40 - len(ext)
-                            display_name = name_part[:max_name_len] + ext
-                            st.warning(f"⚠️ 檔名過長,已自動截短: {original_name} → {display_name}")
-                        
-                        # 根據狀態處理
-                        if file_status == 'unchanged':
-                            st.info(f"⏭️ {uploaded_file.name} 未變更,跳過上傳 (版本 {old_info.get('version', 1)})")
-                            skipped_count += 1
-                            progress_bar.progress((idx + 1) / total_files)
-                            continue
-                        
-                        elif file_status == 'updated':
-                            st.warning(f"🔄 {uploaded_file.name} 已更新,將上傳新版本 (v{old_info.get('version', 1)} → v{old_info.get('version', 1) + 1})")
-                            updated_count += 1
+                    # 計算檔案 hash
+                    file_hash = calculate_file_hash(file_content)
+                    
+                    # 檢查檔案狀態
+                    file_status, old_info = check_file_status(uploaded_file.name, file_hash, selected_store)
+                    
+                    # 處理檔案名稱長度限制 (40 字元)
+                    original_name = uploaded_file.name
+                    display_name = original_name
+                    note = ""
+                    if len(display_name) > 40:
+                        file_path = Path(display_name)
+                        max_name_len = 40 - len(file_path.suffix)
+                        display_name = file_path.stem[:max_name_len] + file_path.suffix
+                        note = f"檔名過長,已自動截短為 {display_name}"
+                    
+                    # 根據狀態處理
+                    if file_status == 'unchanged':
+                        results.append((uploaded_file.name, "⏭️ 跳過", f"未變更 (版本 {old_info.get('version', 1)})"))
+                        skipped_count += 1
+                        completed_count += 1
+                        progress_bar.progress(completed_count / total_files)
+                        continue
+                    
+                    elif file_status == 'updated':
+                        updated_count += 1
+                    
+                    pending_files.append((uploaded_file.name, file_content, file_hash, display_name, file_status, note))
+                
+                # 並行上傳
+                last_status_update = 0.0
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = {
+                        executor.submit(
+                            upload_single_file,
+                            file_content,
+                            file_name,
+                            display_name,
+                            selected_store,
+                            upload_method,
+                            upload_config,
+                            import_config
+                        ): (file_name, file_hash, file_status, note)
+                        for file_name, file_content, file_hash, display_name, file_status, note in pending_files
+                    }
+                    
+                    for future in as_completed(futures):
+                        file_name, file_hash, file_status, note = futures[future]
+                        completed_count += 1
                         
-                        else:  # new
-                            st.info(f"✨ {uploaded_file.name} 是新檔案,開始上傳...")
+                        # 狀態文字最多每 0.5 秒更新一次,減少前端訊息量
+                        if time.monotonic() - last_status_update > 0.5:
+                            status_text.text(f"正在處理: {file_name} ({completed_count}/{total_files})")
+                            last_status_update = time.monotonic()
                         
-                        if upload_method == "直接上傳":
-                            # 準備設定
-                            config = {'display_name': display_name}
-                            
-                            if use_custom_chunking:
-                                config['chunking_config'] = {
-                                    'white_space_config': {
-                                        'max_tokens_per_chunk': max_tokens,
-                                        'max_overlap_tokens': overlap_tokens
-                                    }
-                                }
-                            
-                            if metadata_items:
-                                config['custom_metadata'] = metadata_items
+                        try:
+                            operation = future.result()
                             
-                            # 上傳
-                            operation = client.file_search_stores.upload_to_file_search_store(
-                                file=temp_path,
-                                file_search_store_name=selected_store,
-                                config=config
-                            )
-                        else:
-                            # 先上傳到 Files API
-                            sample_file = client.files.upload(
-                                file=temp_path,
-                                config={'display_name': display_name}
+                            # 註冊檔案到版本控制系統
+                            file_info = register_file(
+                                file_name,
+                                file_hash,
+                                selected_store,
+                                file_id=getattr(operation, 'name', None)
                             )
                             
-                            # 準備匯入設定
-                            import_config = {}
-                            if metadata_items:
-                                import_config['custom_metadata'] = metadata_items
+                            success_count += 1
+                            if file_status == 'updated':
+                                status = "🔄 更新"
+                                detail = f"已上傳新版本 (v{file_info['version'] - 1} → v{file_info['version']})"
+                            else:
+                                status = "✅ 成功"
+                                detail = f"新檔案 (版本 {file_info['version']})"
                             
-                            # 匯入到商店
-                            operation = client.file_search_stores.import_file(
-                                file_search_store_name=selected_store,
-                                file_name=sample_file.name,
-                                **import_config
-                            )
-                        
-                        # 等待操作完成
-                        while not operation.done:
-                            time.sleep(2)
-                            operation = client.operations.get(operation)
-                        
-                        # 註冊檔案到版本控制系統
-                        file_info = register_file(
-                            uploaded_file.name,
-                            file_hash,
-                            selected_store,
-                            file_id=getattr(operation, 'name', None)
-                        )
-                        
-                        # 清理臨時檔案
-                        try:
-                            os.unlink(temp_path)
-                        except:
-                            pass
+                        except Exception as e:
+                            status = "❌ 失敗"
+                            detail = str(e)
                         
-                        success_count += 1
-                        st.success(f"✅ {uploaded_file.name} 上傳成功 (版本 {file_info['version']})")
+                        if note:
+                            detail = f"{detail}; {note}"
+                        results.append((file_name, status, detail))
                         
-                    except Exception as e:
-                        st.error(f"❌ {uploaded_file.name} 上傳失敗: {str(e)}")
-                        # 確保清理臨時檔案
-                        try:
-                            if 'temp_path' in locals():
-                                os.unlink(temp_path)
-                        except:
-                            pass
-                    
-                    progress_bar.progress((idx + 1) / total_files)
+                        progress_bar.progress(completed_count / total_files)
                 
                 # 顯示統計
                 st.markdown("---")
@@ -395,16 +509,25 @@ with tab2:
                 with col4:
                     st.metric("❌ 失敗", total_files - success_count - skipped_count)
                 
+                # 各檔案結果
+                table_rows = ["| 檔案 | 狀態 | 說明 |", "|------|------|------|"]
+                for file_name, status, detail in results:
+                    detail = detail.replace("|", "\\|").replace("\n", " ")
+                    table_rows.append(f"| {file_name} | {status} | {detail} |")
+                st.markdown("\n".join(table_rows))
+                
                 status_text.text(f"完成! 成功 {success_count}、更新 {updated_count}、跳過 {skipped_count} / 總共 {total_files} 個檔案")
                 if success_count > 0:
                     st.balloons()
 
+with tab2:
+    render_upload_tab()
+
 # ===== 標籤頁 3: 統計資訊 =====
-with tab3:
+@st.fragment
+def render_stats_tab():
     st.header("系統統計資訊")
     
-    stores = get_stores()
-    
     col1, col2, col3 = st.columns(3)
     
     with col1:
@@ -419,21 +542,39 @@ with tab3:
     st.divider()
     
     # 各商店詳細資訊
+    # 於工作執行緒中呼叫 (沒有 ScriptRunContext),只能是一般函式,不可使用 st.* 或 st.cache_data
+    def fetch_store_info(store_name):
+        try:
+            store_info = client.file_search_stores.get(name=store_name)
+        except Exception:
+            return None
+        return {
+            "active_documents_count": getattr(store_info, 'active_documents_count', None)
+        }
+    
+    # 快取在主執行緒套用,以整批商店名稱為鍵
+    @st.cache_data(ttl=30, show_spinner=False)
+    def get_store_infos(store_names):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return dict(zip(store_names, executor.map(fetch_store_info, store_names)))
+    
     if stores:
         st.subheader("商店列表")
         
+        # 並行取得各商店資訊
+        store_infos = get_store_infos(tuple(s['name'] for s in stores))
+        
         for store in stores:
             with st.expander(f"📦 {store['display_name']}"):
                 st.markdown(f"**商店 ID:** `{store['name']}`")
                 st.markdown(f"**建立時間:** {store['create_time']}")
                 
                 # 顯示商店資訊
-                try:
-                    store_info = client.file_search_stores.get(name=store['name'])
-                    if hasattr(store_info, 'active_documents_count'):
-                        st.metric("活躍文件數", store_info.active_documents_count)
-                except Exception as e:
+                store_info = store_infos[store['name']]
+                if store_info is None:
                     st.info("無法取得詳細資訊")
+                elif store_info['active_documents_count'] is not None:
+                    st.metric("活躍文件數", store_info['active_documents_count'])
                 
                 st.markdown("---")
                 st.caption("💡 注意: 檔案匯入 FileSearchStore 後會轉為嵌入向量,無法直接列出檔案清單")
@@ -466,8 +607,12 @@ with tab3:
         - **查詢嵌入**: 免費
         """)
 
+with tab3:
+    render_stats_tab()
+
 # ===== 標籤頁 4: 版本控制 =====
-with tab4:
+@st.fragment
+def render_version_tab():
     st.header("🔄 版本控制管理")
     
     registry = load_registry()
@@ -601,6 +746,9 @@ with tab4:
             3. **備份版本記錄**: 定期匯出 JSON 檔案
             """)
 
+with tab4:
+    render_version_tab()
+
 # 頁尾
 st.markdown("---")
 st.caption("💡 提示: 版本控制功能可避免重複上傳,節省索引成本")
\ No newline at end of file
@@ -1,14 +1,47 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extensions import QueryCanceledError
+from contextlib import contextmanager
+from functools import lru_cache
+import csv
+import io
 import os
+import weakref
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterator
 import socket
 import getpass
+import logging
+import pyarrow as pa
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=1)
+def load_system_info() -> Dict[str, str]:
+    """讀取主機名稱、使用者與 IP (程序執行期間不會變動,只在第一次呼叫時查詢 DNS)"""
+    try:
+        hostname = socket.gethostname()
+        username = getpass.getuser()
+        ip_address = socket.gethostbyname(hostname)
+    except:
+        hostname = "unknown"
+        username = "anonymous"
+        ip_address = "127.0.0.1"
+    
+    return {
+        'username': username,
+        'hostname': hostname,
+        'ip_address': ip_address
+    }
 
 class DatabaseManager:
     """PostgreSQL 資料庫管理類別"""
     
+    # 批次寫入超過此筆數時改用 COPY (筆數少時 COPY 的固定成本較高)
+    COPY_THRESHOLD = 20
+    
     def __init__(self):
         """初始化資料庫連線"""
         self.conn_params = {
@@ -16,57 +49,332 @@ class DatabaseManager:
             'port': os.getenv('DB_PORT', '5432'),
             'database': os.getenv('DB_NAME', 'legal_query_system'),
             'user': os.getenv('DB_USER', 'postgres'),
-            'password': os.getenv('DB_PASSWORD', '123456')
+            'password': os.getenv('DB_PASSWORD', '123456'),
+            # 連線逾時與 TCP keepalive,讓失效的連線儘早被偵測
+            'connect_timeout': 5,
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'keepalives_interval': 5,
+            'keepalives_count': 3,
+            'application_name': 'legal_query_system',
+            # 單一查詢最長執行 30 秒
+            'options': '-c statement_timeout=30000'
         }
-        self.conn = None
+        # 連線池預先建立的連線數與上限
+        self.pool_min = int(os.getenv('DB_POOL_MIN', '2'))
+        self.pool_size = int(os.getenv('DB_POOL_SIZE', '10'))
+        self.pool = None
+        # 每個連線已 PREPARE 的陳述式名稱 (連線關閉後自動移除)
+        self.prepared_statements = weakref.WeakKeyDictionary()
         
     def connect(self):
-        """建立資料庫連線"""
+        """建立資料庫連線池"""
         try:
-            self.conn = psycopg2.connect(**self.conn_params)
+            self.pool = ThreadedConnectionPool(
+                min(self.pool_min, self.pool_size), self.pool_size, **self.conn_params
+            )
             return True
         except Exception as e:
-            print(f"資料庫連線失敗: {str(e)}")
+            logger.error("資料庫連線失敗: %s", e)
             return False
     
     def close(self):
-        """關閉資料庫連線"""
-        if self.conn:
-            self.conn.close()
+        """關閉資料庫連線池"""
+        if self.pool:
+            self.pool.closeall()
+    
+    def __enter__(self):
+        """with DatabaseManager() as db: 進入時建立連線池 (失敗時 ping() 回傳 False)"""
+        self.connect()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        """離開 with 區塊時關閉連線池"""
+        self.close()
+        return False
+    
+    def ping(self) -> bool:
+        """以單次 SELECT 1 確認資料庫可用 (健康檢查用,不執行彙總查詢)"""
+        if not self.pool:
+            return False
+        try:
+            with self.get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                result = cursor.fetchone() is not None
+                conn.rollback()
+                return result
+        except Exception as e:
+            logger.error("資料庫健康檢查失敗: %s", e)
+            return False
+    
+    # 聊天介面與資料庫檢視介面所需的索引 (名稱, 定義),由 migrate_viewer_objects 以 CONCURRENTLY 建立
+    VIEWER_INDEXES = [
+        # get_or_create_user 的使用者查詢
+        ('idx_users_username_ip', "users (username, ip_address)"),
+        # get_user_sessions 的 keyset 分頁
+        ('idx_sessions_user_start', "sessions (user_id, session_start DESC)"),
+        # 依會話讀取訊息 (已依 created_at 排序)
+        ('idx_messages_session_created', "messages (session_id, created_at)"),
+        # 依訊息讀取檢索區塊與引用來源
+        ('idx_chunks_message_order', "retrieval_chunks (message_id, chunk_order)"),
+        ('idx_citations_message_order', "citations (message_id, citation_order)"),
+        # 儀表板的最近會話 / 最近警告 (top-K 直接由索引反向掃描取得,不需排序)
+        ('idx_sessions_start_desc',
+         "sessions (session_start DESC) INCLUDE (session_name, total_messages, is_active)"),
+        ('idx_security_warnings_created_desc', "security_warnings (created_at DESC, warning_id DESC)"),
+        # 統計分析的大範圍日期篩選 (會話依時間附加寫入,BRIN 體積極小且可做點陣圖掃描)
+        ('idx_sessions_start_brin', "sessions USING BRIN (session_start) WITH (pages_per_range = 32)"),
+        # 依時間排序 / 分頁的訊息列表
+        ('idx_messages_created_desc', "messages (created_at DESC, message_id DESC)"),
+        # ILIKE '%...%' 搜尋 (前置萬用字元需使用三元組索引)
+        ('idx_messages_content_trgm', "messages USING GIN (content gin_trgm_ops)"),
+        ('idx_chunks_source_trgm', "retrieval_chunks USING GIN (source_document gin_trgm_ops)"),
+        ('idx_users_username_trgm', "users USING GIN (username gin_trgm_ops)")
+    ]
+    
+    # 資料庫檢視介面的會話彙總視圖;唯一索引供 REFRESH ... CONCURRENTLY 使用
+    VIEWER_ROLLUPS = [
+        # 每日會話彙總 (趨勢圖直接讀取,不需每次彙總 sessions)
+        """CREATE MATERIALIZED VIEW IF NOT EXISTS session_daily_counts AS
+            SELECT
+                session_start::date AS date,
+                COUNT(*) AS session_count,
+                COUNT(DISTINCT user_id) AS user_count,
+                SUM(total_messages) AS message_count
+            FROM sessions
+            GROUP BY 1""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_session_daily_counts_date ON session_daily_counts (date)",
+        # 每日每小時會話彙總 (時段 / 星期分布只需加總少量彙總列)
+        """CREATE MATERIALIZED VIEW IF NOT EXISTS session_hourly_counts AS
+            SELECT
+                session_start::date AS date,
+                EXTRACT(HOUR FROM session_start)::int AS hour,
+                EXTRACT(DOW FROM session_start)::int AS dow,
+                COUNT(*) AS session_count
+            FROM sessions
+            GROUP BY 1, 2, 3""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_session_hourly_counts_date_hour ON session_hourly_counts (date, hour)"
+    ]
+    
+    def migrate_viewer_objects(self) -> bool:
+        """
+        建立 pg_trgm 擴充、常用查詢索引與彙總視圖 (由 migrate_db.py 執行,應用程式啟動時不執行任何 DDL)
+        索引以 CREATE INDEX CONCURRENTLY 建立,不會阻擋寫入;CONCURRENTLY 不能在交易中執行,因此使用 autocommit
+        先前中斷而留下的無效索引會先移除再重建
+        """
+        names = [name for name, _ in self.VIEWER_INDEXES]
+        try:
+            with self.get_connection() as conn:
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                        cursor.execute("""
+                            SELECT c.relname
+                            FROM pg_index i
+                            JOIN pg_class c ON c.oid = i.indexrelid
+                            WHERE NOT i.indisvalid AND c.relname = ANY(%s)
+                        """, (names,))
+                        for (name,) in cursor.fetchall():
+                            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                        for name, definition in self.VIEWER_INDEXES:
+                            logger.info("建立索引 %s", name)
+                            cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+                        for statement in self.VIEWER_ROLLUPS:
+                            cursor.execute(statement)
+                finally:
+                    if not conn.closed:
+                        conn.autocommit = False
+            return True
+        except Exception as e:
+            logger.error("資料庫遷移失敗: %s", e)
+            return False
+    
+    def refresh_session_rollups(self) -> bool:
+        """重新整理每日 / 每小時會話彙總 (CONCURRENTLY 不會阻擋讀取)"""
+        results = [
+            self.execute_query(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view}", fetch=False, idempotent=True)
+            for view in ('session_daily_counts', 'session_hourly_counts')
+        ]
+        return all(result is not None for result in results)
+    
+    @contextmanager
+    def get_connection(self):
+        """
+        從連線池借用連線,使用完畢後歸還 (未提交的交易會在歸還時回復)
+        已中斷的連線會直接關閉,連線池之後會建立新連線取代
+        """
+        conn = self.pool.getconn()
+        try:
+            yield conn
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+    
+    @contextmanager
+    def transaction(self):
+        """
+        借用連線並在單一交易中執行,區塊結束時提交一次,發生例外時回復
+        (INSERT ... RETURNING 也需要提交,否則歸還連線時會被回復)
+        """
+        with self.get_connection() as conn:
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                # 連線已中斷時無法回復,保留原本的例外
+                if not conn.closed:
+                    conn.rollback()
+                raise
+    
+    def execute_query(self, query: str, params: tuple = None, fetch: bool = True,
+                      idempotent: bool = None):
+        """
+        執行 SQL 查詢 (fetch 時回傳 RealDictRow 清單,RealDictRow 為 dict 子類別,可直接使用)
+        idempotent: 連線中斷時可否重試 (預設只重試 fetch 查詢;伺服器可能已提交,寫入重試會重複套用)
+        """
+        if idempotent is None:
+            idempotent = fetch
+        # 不取回資料時只需要 rowcount,使用預設的 tuple 游標
+        cursor_factory = RealDictCursor if fetch else None
+        for attempt in range(2):
+            try:
+                with self.transaction() as conn, conn.cursor(cursor_factory=cursor_factory) as cursor:
+                    cursor.execute(query, params)
+                    return cursor.fetchall() if fetch else cursor.rowcount
+            except psycopg2.OperationalError as e:
+                # 連線中斷 (資料庫重啟、閒置逾時) 時以新連線重試一次;查詢逾時與非冪等的寫入不重試
+                if attempt == 0 and idempotent and not isinstance(e, QueryCanceledError):
+                    continue
+                logger.error("查詢執行失敗: %s", e)
+                return None
+            except Exception as e:
+                logger.error("查詢執行失敗: %s", e)
+                return None
+    
+    def execute_prepared(self, name: str, statement: str, params: tuple, fetch: bool = True,
+                         as_dict: bool = True):
+        """
+        以伺服器端預備陳述式執行 SQL,每個連線只在第一次使用時 PREPARE
+        statement 使用 $1, $2 ... 參數
+        as_dict 為 False 時以 tuple 游標回傳 (依欄位順序轉成 DataFrame 時不需建立每列的 dict)
+        """
+        try:
+            with self.get_connection() as conn:
+                prepared = self.prepared_statements.setdefault(conn, set())
+                try:
+                    with conn.cursor(cursor_factory=RealDictCursor if as_dict else None) as cursor:
+                        if name not in prepared:
+                            cursor.execute(f"PREPARE {name} AS {statement}")
+                            prepared.add(name)
+                        placeholders = ", ".join(["%s"] * len(params))
+                        cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+                        result = cursor.fetchall() if fetch else cursor.rowcount
+                    conn.commit()
+                    return result
+                except Exception:
+                    conn.rollback()
+                    # 無法確定伺服器端狀態,清除此連線的預備陳述式後下次重新 PREPARE
+                    self.prepared_statements.pop(conn, None)
+                    with conn.cursor() as cursor:
+                        cursor.execute("DEALLOCATE ALL")
+                    conn.commit()
+                    raise
+        except Exception as e:
+            logger.error("查詢執行失敗: %s", e)
+            return None
     
-    def execute_query(self, query: str, params: tuple = None, fetch: bool = True):
-        """執行 SQL 查詢"""
+    def execute_arrow(self, query: str, params: tuple = None) -> Optional[pa.Table]:
+        """執行查詢並以欄為單位組成 pyarrow.Table (不建立每列的 dict,可直接交給 st.dataframe)"""
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            with self.transaction() as conn, conn.cursor() as cursor:
                 cursor.execute(query, params)
-                if fetch:
-                    return cursor.fetchall()
-                else:
-                    self.conn.commit()
-                    return cursor.rowcount
+                names = [column.name for column in cursor.description]
+                rows = cursor.fetchall()
         except Exception as e:
-            self.conn.rollback()
-            print(f"查詢執行失敗: {str(e)}")
+            logger.error("查詢執行失敗: %s", e)
             return None
+        columns = zip(*rows) if rows else ([] for _ in names)
+        return pa.Table.from_arrays([pa.array(column) for column in columns], names=names)
+    
+    def query_df(self, query: str, params: tuple = None, read_only: bool = False) -> Optional[pd.DataFrame]:
+        """
+        執行查詢並直接建立 DataFrame (以 tuple 游標讀取,不經過每列的 dict)
+        未使用 pd.read_sql_query: pandas 只正式支援 SQLAlchemy 連線,傳入 psycopg2 連線會發出警告
+        read_only 為 True 時在唯讀交易中執行,任何寫入 (包含 CTE 內的 DELETE / UPDATE) 都會被資料庫拒絕
+        """
+        try:
+            with self.transaction() as conn, conn.cursor() as cursor:
+                if read_only:
+                    cursor.execute("SET TRANSACTION READ ONLY")
+                cursor.execute(query, params)
+                columns = [column.name for column in cursor.description]
+                return pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+        except Exception as e:
+            logger.error("查詢執行失敗: %s", e)
+            return None
+    
+    def stream_query(self, query: str, params: tuple = None, itersize: int = 50,
+                     name: str = 'stream_query') -> Iterator[Dict]:
+        """
+        以伺服器端 (具名) 游標逐批讀取查詢結果,適用於可能很大的查詢
+        讀取途中發生錯誤時記錄後重新拋出,呼叫端才能得知結果不完整
+        """
+        try:
+            with self.transaction() as conn, conn.cursor(
+                name=name, cursor_factory=RealDictCursor
+            ) as cursor:
+                cursor.itersize = itersize
+                cursor.execute(query, params)
+                yield from cursor
+        except Exception as e:
+            logger.error("查詢執行失敗: %s", e)
+            raise
+    
+    def execute_batch_insert(self, query: str, rows: List[tuple], cursor=None) -> bool:
+        """
+        以單一 INSERT 陳述式批次寫入多筆資料 (query 需使用 VALUES %s)
+        傳入 cursor 時在呼叫端的交易中執行,錯誤直接拋出由呼叫端回復
+        """
+        if not rows:
+            return True
+        if cursor is not None:
+            execute_values(cursor, query, rows, page_size=len(rows))
+            return True
+        try:
+            with self.transaction() as conn, conn.cursor() as cursor:
+                return self.execute_batch_insert(query, rows, cursor)
+        except Exception as e:
+            logger.error("批次寫入失敗: %s", e)
+            return False
+    
+    def execute_copy(self, table: str, columns: List[str], rows: List[tuple], cursor=None) -> bool:
+        """
+        以 COPY ... FROM STDIN 批次寫入多筆資料 (不支援 RETURNING)
+        傳入 cursor 時在呼叫端的交易中執行,錯誤直接拋出由呼叫端回復
+        字串一律加上引號: CSV 格式中未加引號的空欄位會被讀成 NULL,空字串需寫成 ""
+        (與 execute_values 相同存成 '';None 也會寫成空字串)
+        """
+        if not rows:
+            return True
+        if cursor is not None:
+            buffer = io.StringIO()
+            csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+            buffer.seek(0)
+            query = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+            cursor.copy_expert(query, buffer)
+            return True
+        try:
+            with self.transaction() as conn, conn.cursor() as cursor:
+                return self.execute_copy(table, columns, rows, cursor)
+        except Exception as e:
+            logger.error("批次寫入失敗: %s", e)
+            return False
     
     # ===== 使用者管理 =====
     
     def get_system_info(self) -> Dict[str, str]:
         """取得系統資訊"""
-        try:
-            hostname = socket.gethostname()
-            username = getpass.getuser()
-            ip_address = socket.gethostbyname(hostname)
-        except:
-            hostname = "unknown"
-            username = "anonymous"
-            ip_address = "127.0.0.1"
-        
-        return {
-            'username': username,
-            'hostname': hostname,
-            'ip_address': ip_address
-        }
+        return dict(load_system_info())
     
     def get_or_create_user(self, username: str = None, ip_address: str = None) -> Optional[int]:
         """取得或建立使用者"""
@@ -75,40 +383,34 @@ class DatabaseManager:
             username = username or sys_info['username']
             ip_address = ip_address or sys_info['ip_address']
         
-        # 檢查使用者是否存在
+        # 更新既有使用者的最後訪問時間,不存在時建立新使用者 (單次查詢)
+        # users 表的 (username, ip_address) 未必有唯一約束,因此不使用 ON CONFLICT
         query = """
-            SELECT user_id FROM users 
-            WHERE username = %s AND ip_address = %s::inet
-        """
-        result = self.execute_query(query, (username, ip_address))
-        
-        if result:
-            # 更新最後訪問時間
-            update_query = """
+            WITH existing AS (
                 UPDATE users 
                 SET last_visit = CURRENT_TIMESTAMP 
-                WHERE user_id = %s
-            """
-            self.execute_query(update_query, (result[0]['user_id'],), fetch=False)
-            return result[0]['user_id']
-        else:
-            # 建立新使用者
-            insert_query = """
+                WHERE username = %s AND ip_address = %s::inet
+                RETURNING user_id
+            ), inserted AS (
                 INSERT INTO users (username, ip_address) 
-                VALUES (%s, %s::inet) 
+                SELECT %s, %s::inet 
+                WHERE NOT EXISTS (SELECT 1 FROM existing)
                 RETURNING user_id
-            """
-            result = self.execute_query(insert_query, (username, ip_address))
-            if result:
-                return result[0]['user_id']
-        
-        return None
+            )
+            SELECT user_id FROM existing
+            UNION ALL
+            SELECT user_id FROM inserted
+            LIMIT 1
+        """
+        # 重試時會由 UPDATE 找到先前已新增的使用者,不會重複建立
+        result = self.execute_query(query, (username, ip_address, username, ip_address), idempotent=True)
+        return result[0]['user_id'] if result else None
     
     def get_user_info(self, user_id: int) -> Optional[Dict]:
         """取得使用者資訊"""
         query = "SELECT * FROM user_statistics WHERE user_id = %s"
         result = self.execute_query(query, (user_id,))
-        return dict(result[0]) if result else None
+        return result[0] if result else None
     
     # ===== 會話管理 =====
     
@@ -120,38 +422,52 @@ class DatabaseManager:
             VALUES (%s, %s, %s) 
             RETURNING session_id
         """
-        result = self.execute_query(query, (user_id, session_name, knowledge_base))
+        # INSERT ... RETURNING: 連線中斷時伺服器可能已提交,不重試以免建立重複的會話
+        result = self.execute_query(query, (user_id, session_name, knowledge_base), idempotent=False)
         return result[0]['session_id'] if result else None
     
-    def get_user_sessions(self, user_id: int, active_only: bool = False) -> List[Dict]:
-        """取得使用者的所有會話"""
-        query = """
-            SELECT * FROM session_summary 
-            WHERE user_id = %s
+    def get_user_sessions(self, user_id: int, active_only: bool = False,
+                         limit: int = None, before: datetime = None) -> List[Dict]:
         """
-        if active_only:
-            query += " AND is_active = TRUE"
-        query += " ORDER BY session_start DESC"
-        
-        # 修正: 需要加入 user_id 欄位
+        取得使用者的會話 (依開始時間由新到舊)
+        limit / before 用於 keyset 分頁: 下一頁傳入上一頁最後一筆的 session_start
+        """
+        # session_summary 沒有 user_id 欄位,需透過 sessions 取得
         query = """
-            SELECT s.*, u.user_id FROM session_summary s
+            SELECT s.*, sess.user_id FROM session_summary s
             JOIN sessions sess ON s.session_id = sess.session_id
-            JOIN users u ON sess.user_id = u.user_id
-            WHERE u.user_id = %s
+            WHERE sess.user_id = %s
         """
+        params = [user_id]
         if active_only:
             query += " AND s.is_active = TRUE"
-        query += " ORDER BY s.session_start DESC"
+        if before is not None:
+            query += " AND s.session_start < %s"
+            params.append(before)
+        query += " ORDER BY s.session_start DESC LIMIT %s"
+        params.append(limit)
         
-        result = self.execute_query(query, (user_id,))
-        return [dict(row) for row in result] if result else []
+        result = self.execute_query(query, tuple(params))
+        return result or []
+    
+    def get_sessions_for_users(self, user_ids: List[int]) -> List[Dict]:
+        """一次查詢取得多位使用者的會話 (依 user_id、開始時間由新到舊排序)"""
+        if not user_ids:
+            return []
+        query = """
+            SELECT s.*, sess.user_id FROM session_summary s
+            JOIN sessions sess ON s.session_id = sess.session_id
+            WHERE sess.user_id = ANY(%s)
+            ORDER BY sess.user_id, s.session_start DESC
+        """
+        result = self.execute_query(query, (list(user_ids),))
+        return result or []
     
     def get_session_detail(self, session_id: int) -> Optional[Dict]:
         """取得會話詳細資訊"""
         query = "SELECT * FROM session_summary WHERE session_id = %s"
         result = self.execute_query(query, (session_id,))
-        return dict(result[0]) if result else None
+        return result[0] if result else None
     
     def update_session_name(self, session_id: int, new_name: str) -> bool:
         """更新會話名稱"""
@@ -181,18 +497,100 @@ class DatabaseManager:
                    tokens_used: int = None, has_chunks: bool = False,
                    chunk_count: int = 0) -> Optional[int]:
         """新增訊息"""
-        query = """
+        statement = """
             INSERT INTO messages 
             (session_id, role, content, tokens_used, has_chunks, chunk_count) 
-            VALUES (%s, %s, %s, %s, %s, %s) 
+            VALUES ($1, $2, $3, $4, $5, $6) 
             RETURNING message_id
         """
-        result = self.execute_query(
-            query, 
+        result = self.execute_prepared(
+            'add_message',
+            statement,
             (session_id, role, content, tokens_used, has_chunks, chunk_count)
         )
         return result[0]['message_id'] if result else None
     
+    def record_assistant_turn(self, session_id: int, content: str,
+                              chunks: List[Dict] = None,
+                              citations: List[Dict] = None) -> Optional[int]:
+        """
+        以單一陳述式 (一次往返、一次提交) 新增 AI 回答及其檢索區塊與引用來源
+        (區塊數達 COPY_THRESHOLD 時改由 record_large_assistant_turn 寫入)
+        Returns: message_id,失敗時回傳 None
+        """
+        chunks = chunks or []
+        citations = citations or []
+        if len(chunks) >= self.COPY_THRESHOLD:
+            return self.record_large_assistant_turn(session_id, content, chunks, citations)
+        try:
+            with self.transaction() as conn, conn.cursor() as cursor:
+                ctes = [cursor.mogrify("""
+                    m AS (
+                        INSERT INTO messages 
+                        (session_id, role, content, has_chunks, chunk_count) 
+                        VALUES (%s, 'assistant', %s, %s, %s) 
+                        RETURNING message_id
+                    )""", (session_id, content, bool(chunks), len(chunks))).decode()]
+                
+                if chunks:
+                    values = ", ".join(
+                        cursor.mogrify("(%s, %s, %s)", (
+                            chunk.get('source', 'Unknown'), chunk.get('text', ''), idx
+                        )).decode()
+                        for idx, chunk in enumerate(chunks, 1)
+                    )
+                    ctes.append(f"""
+                    c AS (
+                        INSERT INTO retrieval_chunks 
+                        (message_id, source_document, chunk_text, chunk_order) 
+                        SELECT m.message_id, v.source_document, v.chunk_text, v.chunk_order 
+                        FROM m, (VALUES {values}) AS v(source_document, chunk_text, chunk_order)
+                    )""")
+                
+                if citations:
+                    values = ", ".join(
+                        cursor.mogrify("(%s, %s, %s)", (
+                            citation.get('document', 'Unknown'), citation.get('chunk_id', ''), idx
+                        )).decode()
+                        for idx, citation in enumerate(citations, 1)
+                    )
+                    ctes.append(f"""
+                    ci AS (
+                        INSERT INTO citations 
+                        (message_id, document_name, chunk_reference, citation_order) 
+                        SELECT m.message_id, v.document_name, v.chunk_reference, v.citation_order 
+                        FROM m, (VALUES {values}) AS v(document_name, chunk_reference, citation_order)
+                    )""")
+                
+                cursor.execute(f"WITH {','.join(ctes)} SELECT message_id FROM m")
+                return cursor.fetchone()[0]
+        except Exception as e:
+            logger.error("查詢執行失敗: %s", e)
+            return None
+    
+    def record_large_assistant_turn(self, session_id: int, content: str,
+                                    chunks: List[Dict], citations: List[Dict]) -> Optional[int]:
+        """
+        區塊數量多時,在同一交易中先新增 AI 回答,再以 COPY 寫入檢索區塊、批次寫入引用來源
+        (避免把大量區塊內容組成單一 SQL 字串)
+        Returns: message_id,失敗時回傳 None (整個交易回復)
+        """
+        try:
+            with self.transaction() as conn, conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO messages 
+                    (session_id, role, content, has_chunks, chunk_count) 
+                    VALUES (%s, 'assistant', %s, %s, %s) 
+                    RETURNING message_id
+                """, (session_id, content, bool(chunks), len(chunks)))
+                message_id = cursor.fetchone()[0]
+                self.add_retrieval_chunks(message_id, chunks, cursor)
+                self.add_citations(message_id, citations, cursor)
+                return message_id
+        except Exception as e:
+            logger.error("查詢執行失敗: %s", e)
+            return None
+    
     def get_session_messages(self, session_id: int) -> List[Dict]:
         """取得會話的所有訊息"""
         query = """
@@ -201,7 +599,48 @@ class DatabaseManager:
             ORDER BY created_at ASC
         """
         result = self.execute_query(query, (session_id,))
-        return [dict(row) for row in result] if result else []
+        return result or []
+    
+    def iter_session_messages(self, session_id: int, itersize: int = 500) -> Iterator[Dict]:
+        """以伺服器端游標逐批讀取會話訊息,記憶體中最多只保留 itersize 筆"""
+        query = """
+            SELECT * FROM messages 
+            WHERE session_id = %s 
+            ORDER BY created_at ASC
+        """
+        return self.stream_query(query, (session_id,), itersize, name='session_messages')
+    
+    def get_session_bundle(self, session_id: int, limit: int = None,
+                          include_chunks: bool = True) -> List[Dict]:
+        """
+        一次查詢取得會話訊息及每則訊息的引用來源與檢索區塊
+        (citations / chunks 為依順序排列的清單,沒有資料時為 None)
+        """
+        chunks_column = """,
+                (SELECT json_agg(json_build_object(
+                            'source_document', c.source_document,
+                            'chunk_text', c.chunk_text
+                        ) ORDER BY c.chunk_order)
+                 FROM retrieval_chunks c
+                 WHERE c.message_id = m.message_id) AS chunks""" if include_chunks else ""
+        query = f"""
+            SELECT * FROM (
+                SELECT m.*,
+                    (SELECT json_agg(json_build_object(
+                                'document_name', ci.document_name,
+                                'chunk_reference', ci.chunk_reference
+                            ) ORDER BY ci.citation_order)
+                     FROM citations ci
+                     WHERE ci.message_id = m.message_id) AS citations{chunks_column}
+                FROM messages m
+                WHERE m.session_id = %s
+                ORDER BY m.created_at DESC
+                LIMIT %s
+            ) recent
+            ORDER BY created_at ASC
+        """
+        result = self.execute_query(query, (session_id, limit))
+        return result or []
     
     # ===== 檢索區塊管理 =====
     
@@ -220,15 +659,41 @@ class DatabaseManager:
         )
         return result is not None
     
+    def add_retrieval_chunks(self, message_id: int, chunks: List[Dict], cursor=None) -> bool:
+        """
+        批次新增檢索區塊 (chunk_order 依清單順序從 1 開始)
+        傳入 cursor 時在呼叫端的交易中寫入
+        """
+        query = """
+            INSERT INTO retrieval_chunks 
+            (message_id, source_document, chunk_text, chunk_order) 
+            VALUES %s
+        """
+        rows = [
+            (message_id, chunk.get('source', 'Unknown'), chunk.get('text', ''), idx)
+            for idx, chunk in enumerate(chunks, 1)
+        ]
+        if len(rows) >= self.COPY_THRESHOLD:
+            return self.execute_copy(
+                'retrieval_chunks',
+                ['message_id', 'source_document', 'chunk_text', 'chunk_order'],
+                rows,
+                cursor
+            )
+        return self.execute_batch_insert(query, rows, cursor)
+    
     def get_message_chunks(self, message_id: int) -> List[Dict]:
-        """取得訊息的檢索區塊"""
+        """
+        取得訊息的檢索區塊
+        (由資料庫彙整成單一 JSON 陣列,時間欄位為 ISO 格式字串)
+        """
         query = """
-            SELECT * FROM retrieval_chunks 
-            WHERE message_id = %s 
-            ORDER BY chunk_order ASC
+            SELECT json_agg(to_json(c) ORDER BY c.chunk_order) AS chunks
+            FROM retrieval_chunks c 
+            WHERE c.message_id = %s
         """
         result = self.execute_query(query, (message_id,))
-        return [dict(row) for row in result] if result else []
+        return (result[0]['chunks'] if result else None) or []
     
     # ===== 引用來源管理 =====
     
@@ -247,15 +712,34 @@ class DatabaseManager:
         )
         return result is not None
     
+    def add_citations(self, message_id: int, citations: List[Dict], cursor=None) -> bool:
+        """
+        批次新增引用來源 (citation_order 依清單順序從 1 開始)
+        傳入 cursor 時在呼叫端的交易中寫入
+        """
+        query = """
+            INSERT INTO citations 
+            (message_id, document_name, chunk_reference, citation_order) 
+            VALUES %s
+        """
+        rows = [
+            (message_id, citation.get('document', 'Unknown'), citation.get('chunk_id', ''), idx)
+            for idx, citation in enumerate(citations, 1)
+        ]
+        return self.execute_batch_insert(query, rows, cursor)
+    
     def get_message_citations(self, message_id: int) -> List[Dict]:
-        """取得訊息的引用來源"""
+        """
+        取得訊息的引用來源
+        (由資料庫彙整成單一 JSON 陣列,時間欄位為 ISO 格式字串)
+        """
         query = """
-            SELECT * FROM citations 
-            WHERE message_id = %s 
-            ORDER BY citation_order ASC
+            SELECT json_agg(to_json(ci) ORDER BY ci.citation_order) AS citations
+            FROM citations ci 
+            WHERE ci.message_id = %s
         """
         result = self.execute_query(query, (message_id,))
-        return [dict(row) for row in result] if result else []
+        return (result[0]['citations'] if result else None) or []
     
     # ===== 安全警告管理 =====
     
@@ -283,7 +767,7 @@ class DatabaseManager:
             ORDER BY created_at DESC
         """
         result = self.execute_query(query, (session_id,))
-        return [dict(row) for row in result] if result else []
+        return result or []
     
     # ===== 會話設定管理 =====
     
@@ -315,40 +799,39 @@ class DatabaseManager:
             LIMIT 1
         """
         result = self.execute_query(query, (session_id,))
-        return dict(result[0]) if result else None
+        return result[0] if result else None
     
     # ===== 統計查詢 =====
     
-    def get_statistics(self) -> Dict[str, Any]:
-        """取得系統統計資訊"""
-        stats = {}
-        
-        # 總使用者數
-        query = "SELECT COUNT(*) as total FROM users"
-        result = self.execute_query(query)
-        stats['total_users'] = result[0]['total'] if result else 0
-        
-        # 總會話數
-        query = "SELECT COUNT(*) as total FROM sessions"
-        result = self.execute_query(query)
-        stats['total_sessions'] = result[0]['total'] if result else 0
-        
-        # 總訊息數
-        query = "SELECT COUNT(*) as total FROM messages"
-        result = self.execute_query(query)
-        stats['total_messages'] = result[0]['total'] if result else 0
-        
-        # 今日活躍會話
-        query = """
-            SELECT COUNT(*) as total FROM sessions 
-            WHERE DATE(session_start) = CURRENT_DATE
+    def get_statistics(self, approximate: bool = False) -> Dict[str, Any]:
+        """
+        取得系統統計資訊 (單次查詢)
+        approximate 為 True 時訊息總數改用 pg_class.reltuples 估計值 (VACUUM / ANALYZE 後更新),
+        避免每次都完整掃描 messages;尚未分析過的資料表仍使用精確計數
+        """
+        if approximate:
+            total_messages = """(SELECT CASE WHEN reltuples >= 0 THEN reltuples::bigint
+                                        ELSE (SELECT COUNT(*) FROM messages) END
+                 FROM pg_class WHERE oid = 'messages'::regclass)"""
+        else:
+            total_messages = "(SELECT COUNT(*) FROM messages)"
+        query = f"""
+            SELECT
+                (SELECT COUNT(*) FROM users) AS total_users,
+                (SELECT COUNT(*) FROM sessions) AS total_sessions,
+                {total_messages} AS total_messages,
+                (SELECT COUNT(*) FROM sessions
+                 WHERE session_start >= CURRENT_DATE
+                   AND session_start < CURRENT_DATE + 1) AS today_sessions,
+                (SELECT COUNT(*) FROM security_warnings) AS total_warnings
         """
         result = self.execute_query(query)
-        stats['today_sessions'] = result[0]['total'] if result else 0
-        
-        # 安全警告數
-        query = "SELECT COUNT(*) as total FROM security_warnings"
-        result = self.execute_query(query)
-        stats['total_warnings'] = result[0]['total'] if result else 0
-        
-        return stats
\ No newline at end of file
+        if not result:
+            return {
+                'total_users': 0,
+                'total_sessions': 0,
+                'total_messages': 0,
+                'today_sessions': 0,
+                'total_warnings': 0
+            }
+        return result[0]
@@ -1,5 +1,7 @@
 import streamlit as st
 import pandas as pd
+import re
+import threading
 from db_manager import DatabaseManager
 from datetime import datetime, timedelta
 import plotly.express as px
@@ -25,6 +27,213 @@ def init_database():
 
 db = init_database()
 
+# 唯讀查詢快取,避免每次重新執行腳本都打到資料庫
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_query(query, params=()):
+    return db.execute_query(query, params or None)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def cached_report_df(query, params=(), rollup_version=None):
+    # 統計分析的彙總查詢以 (SQL, 參數/日期範圍) 為鍵快取較長時間
+    return db.query_df(query, params or None)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_prepared(name, statement, params, as_dict=True, rollup_version=None):
+    # 儀表板固定查詢使用預備陳述式,每個連線只解析與規劃一次
+    # (讀取彙總視圖時傳入 rollup_version,視圖重新整理後快取自動失效)
+    return db.execute_prepared(name, statement, params, as_dict=as_dict)
+
+# 會話彙總視圖的重新整理間隔 (秒)
+ROLLUP_REFRESH_SECONDS = 300
+
+@st.cache_resource
+def get_rollup_state():
+    # 所有使用者共用的重新整理狀態與鎖 (不受「重新整理」按鈕的 st.cache_data.clear() 影響)
+    return {
+        'lock': threading.Lock(),
+        'checked_at': None,
+        'refreshed_at': None,
+        'running': False,
+        'failed': False
+    }
+
+def run_rollup_refresh(state):
+    """於背景執行緒重新整理會話彙總 (不可呼叫 st.* 函式)"""
+    ok = db.refresh_session_rollups()
+    with state['lock']:
+        state['running'] = False
+        state['failed'] = not ok
+        if ok:
+            state['refreshed_at'] = datetime.now()
+
+def refresh_session_rollups():
+    """
+    會話彙總最多每 ROLLUP_REFRESH_SECONDS 秒重新整理一次 (失敗時同樣等到下個間隔再重試)
+    重新整理在背景執行緒進行,頁面不等待完成,先顯示目前的彙總資料
+    Returns: 共用的狀態 dict (refreshed_at 為最後一次成功重新整理的時間)
+    """
+    state = get_rollup_state()
+    with state['lock']:
+        now = datetime.now()
+        due = state['checked_at'] is None or now - state['checked_at'] >= timedelta(seconds=ROLLUP_REFRESH_SECONDS)
+        if due and not state['running']:
+            state['checked_at'] = now
+            state['running'] = True
+            threading.Thread(target=run_rollup_refresh, args=(state,), daemon=True).start()
+    return state
+
+def show_rollup_caption(rollup):
+    """顯示彙總資料的更新時間"""
+    if rollup['failed']:
+        st.caption("⚠️ 彙總資料無法更新,請確認已執行 migrate_db.py")
+    elif rollup['refreshed_at']:
+        st.caption(f"🕐 彙總資料更新於 {rollup['refreshed_at'].strftime('%Y-%m-%d %H:%M:%S')} (每 {ROLLUP_REFRESH_SECONDS // 60} 分鐘更新)")
+    else:
+        st.caption("🔄 彙總資料更新中,稍後重新整理即可看到最新數據")
+
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_arrow_query(query, params=()):
+    # 純顯示的表格直接取得欄式資料,不經過 dict 與 DataFrame
+    return db.execute_arrow(query, params or None)
+
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_statistics():
+    # 側邊欄與儀表板共用同一份結果;訊息總數為估計值
+    return db.get_statistics(approximate=True)
+
+# 各表格的欄位順序 (DataFrame.from_records 直接依此順序建立欄位)
+RECENT_SESSION_COLUMNS = ('session_name', 'username', 'total_messages', 'is_active', 'session_start')
+RECENT_WARNING_COLUMNS = ('warning_type', 'warning_message', 'created_at')
+USER_COLUMNS = (
+    'user_id', 'username', 'ip_address',
+    'total_sessions', 'total_queries', 'active_sessions',
+    'total_warnings', 'first_visit', 'last_visit'
+)
+USER_SESSION_COLUMNS = (
+    'session_id', 'session_name', 'total_messages',
+    'warning_count', 'session_start', 'is_active'
+)
+SESSION_COLUMNS = (
+    'session_id', 'session_name', 'username',
+    'knowledge_base', 'total_messages', 'warning_count',
+    'is_active', 'session_start'
+)
+CITATION_COLUMNS = (
+    'document_name', 'chunk_reference', 'username',
+    'session_name', 'citation_order', 'created_at'
+)
+MESSAGE_COLUMNS = ('created_at', 'username', 'session_name', 'role', 'content', 'chunk_count', 'tokens_used')
+CHUNK_COLUMNS = ('created_at', 'source_document', 'username', 'session_name', 'chunk_order')
+WARNING_COLUMNS = ('created_at', 'warning_type', 'username', 'session_name', 'warning_message')
+SETTING_COLUMNS = (
+    'created_at', 'session_name', 'username', 'model_name',
+    'use_metadata_filter', 'security_enabled'
+)
+
+# 趨勢圖最多傳送到瀏覽器的資料點數 (超過時以 LTTB 降採樣)
+MAX_TREND_POINTS = 500
+
+def lttb_indices(values, threshold=MAX_TREND_POINTS):
+    """Largest-Triangle-Three-Buckets 降採樣,回傳保留的資料點索引 (保留首尾與每桶最能代表形狀的點)"""
+    n = len(values)
+    if n <= threshold or threshold < 3:
+        return list(range(n))
+    
+    bucket_size = (n - 2) / (threshold - 2)
+    indices = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        
+        # 下一桶的平均點作為三角形的第三個頂點
+        avg_x = (end + next_end - 1) / 2
+        avg_y = sum(values[end:next_end]) / (next_end - end)
+        
+        a = max(
+            range(start, end),
+            key=lambda j: abs((a - avg_x) * (values[j] - values[a]) - (a - j) * (avg_y - values[a]))
+        )
+        indices.append(a)
+    indices.append(n - 1)
+    return indices
+
+def downsample_series(df, x_column, y_column):
+    """取得降採樣後的 x / y 序列供繪圖使用"""
+    indices = lttb_indices(df[y_column].astype(float).tolist())
+    return df[x_column].iloc[indices], df[y_column].iloc[indices]
+
+def get_selected_row(event, rows):
+    """取得表格中選取的列 (未選取或選取位置已超出目前資料時回傳 None)"""
+    selected = event.selection.rows
+    if selected and selected[0] < len(rows):
+        return rows[selected[0]]
+    return None
+
+# 時間欄位交由瀏覽器端格式化,DataFrame 保留原始 datetime
+DATETIME_COLUMN = st.column_config.DatetimeColumn(format="YYYY-MM-DD HH:mm")
+
+# 檢索區塊預設顯示的字數
+CHUNK_PREVIEW_CHARS = 2000
+
+# 會話狀態顯示 (以 eq(True) 轉為布林欄後整欄對應,NULL 視為已結束)
+ACTIVE_LABELS = {True: '🟢 活躍', False: '⚪ 結束'}
+
+# 綜合報表詳細統計的欄位與顯示名稱
+REPORT_METRICS = {
+    'total_sessions': "總會話數",
+    'unique_users': "獨立使用者數",
+    'total_messages': "總訊息數",
+    'user_messages': "使用者訊息",
+    'ai_messages': "AI 回覆",
+    'total_chunks': "檢索區塊",
+    'total_citations': "引用次數",
+    'total_warnings': "安全警告",
+    'avg_messages_per_session': "平均訊息/會話"
+}
+
+# EXTRACT(DOW) 的星期對應 (0 = 星期日)
+WEEKDAY_NAMES = {0: '星期日', 1: '星期一', 2: '星期二', 3: '星期三', 4: '星期四', 5: '星期五', 6: '星期六'}
+
+# 自訂 SQL 查詢允許的開頭關鍵字 (實際寫入由唯讀交易阻擋)
+READ_ONLY_KEYWORDS = ('SELECT', 'WITH')
+
+# 自訂 SQL 查詢最多取回的筆數 (外層包上 LIMIT,限制記憶體用量)
+MAX_SQL_RESULT_ROWS = 10000
+
+def get_leading_keyword(sql):
+    """取得 SQL 的第一個關鍵字 (略過開頭的空白與註解)"""
+    match = re.match(r"(?:\s+|--[^\n]*|/\*.*?\*/)*(\w+)", sql, re.S)
+    return match.group(1).upper() if match else ""
+
+# 列表頁面每頁筆數 (以 created_at + ID 做 keyset 分頁,不使用 OFFSET)
+PAGE_SIZE = 50
+
+def get_page_cursor(key, filters=()):
+    """取得分頁游標 (上一頁最後一筆的 created_at 與 ID);篩選條件改變時回到第一頁"""
+    if st.session_state.get(f"{key}_filters") != filters:
+        st.session_state[f"{key}_filters"] = filters
+        st.session_state.pop(f"{key}_cursor", None)
+    return st.session_state.get(f"{key}_cursor")
+
+def render_page_nav(key, row_count, last_row, id_column, page_size=PAGE_SIZE):
+    """顯示分頁按鈕,載入下一頁時記錄本頁最後一筆 (last_row) 作為游標"""
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        if st.session_state.get(f"{key}_cursor") is not None:
+            if st.button("⏮️ 回到第一頁", key=f"{key}_first"):
+                st.session_state.pop(f"{key}_cursor", None)
+                st.rerun()
+    
+    with col2:
+        # 本頁未滿代表已無更多資料
+        if row_count == page_size:
+            if st.button("⏭️ 載入下一頁", key=f"{key}_next"):
+                st.session_state[f"{key}_cursor"] = (last_row['created_at'], last_row[id_column])
+                st.rerun()
+
 # 標題
 st.title("🗄️ 資料庫管理介面")
 st.markdown("查詢和管理系統所有資料表")
@@ -53,7 +262,7 @@ with st.sidebar:
     
     # 快速統計
     st.subheader("📈 即時統計")
-    stats = db.get_statistics()
+    stats = cached_statistics()
     st.metric("總使用者", stats['total_users'])
     st.metric("總會話", stats['total_sessions'])
     st.metric("總訊息", stats['total_messages'])
@@ -68,6 +277,156 @@ with st.sidebar:
         st.cache_data.clear()
         st.rerun()
 
+# ===== 儀表板區塊 =====
+# 各區塊為獨立 fragment,互動或定時更新時只重新執行該區塊
+
+@st.fragment(run_every=60)
+def render_recent_sessions():
+    """最近會話"""
+    st.subheader("🕐 最近會話")
+    query = """
+        SELECT 
+            session_id,
+            session_name,
+            username,
+            session_start,
+            total_messages,
+            is_active
+        FROM session_summary
+        ORDER BY session_start DESC
+        LIMIT $1
+    """
+    recent_sessions = cached_prepared('recent_sessions', query, (10,))
+    
+    if recent_sessions:
+        # psycopg2 已將時間欄位轉為 datetime,不需再 pd.to_datetime
+        df = pd.DataFrame.from_records(recent_sessions, columns=RECENT_SESSION_COLUMNS)
+        df['is_active'] = df['is_active'].eq(True).map(ACTIVE_LABELS)
+        df.columns = ['會話名稱', '使用者', '訊息數', '狀態', '開始時間']
+        st.dataframe(df, width='stretch', hide_index=True, column_config={"開始時間": DATETIME_COLUMN})
+    else:
+        st.info("尚無會話記錄")
+
+@st.fragment(run_every=60)
+def render_recent_warnings():
+    """最近警告"""
+    st.subheader("⚠️ 最近警告")
+    query = """
+        SELECT 
+            warning_type,
+            warning_message,
+            created_at
+        FROM security_warnings
+        ORDER BY created_at DESC
+        LIMIT $1
+    """
+    recent_warnings = cached_prepared('recent_warnings', query, (10,))
+    
+    if recent_warnings:
+        df = pd.DataFrame.from_records(recent_warnings, columns=RECENT_WARNING_COLUMNS)
+        df.columns = ['類型', '訊息', '時間']
+        st.dataframe(df, width='stretch', hide_index=True, column_config={"時間": DATETIME_COLUMN})
+    else:
+        st.success("✅ 無安全警告")
+
+@st.fragment(run_every=60)
+def render_session_trend():
+    """每日會話數趨勢"""
+    rollup = refresh_session_rollups()
+    query = """
+        SELECT 
+            date,
+            session_count
+        FROM session_daily_counts
+        WHERE date >= CURRENT_DATE - $1::integer
+        ORDER BY date
+    """
+    trend_data = cached_prepared('trend_30d', query, (30,), as_dict=False, rollup_version=rollup['refreshed_at'])
+    show_rollup_caption(rollup)
+    
+    if trend_data:
+        df = pd.DataFrame.from_records(trend_data, columns=('date', 'session_count'))
+        
+        fig = px.line(
+            df, 
+            x='date', 
+            y='session_count',
+            title='每日會話數 (最近30天)',
+            labels={'date': '日期', 'session_count': '會話數'},
+            render_mode='webgl'
+        )
+        fig.update_traces(mode='lines+markers')
+        st.plotly_chart(fig, width='stretch', key='dash_trend')
+    else:
+        st.info("暫無數據")
+
+@st.fragment(run_every=60)
+def render_user_activity():
+    """使用者活躍度"""
+    query = """
+        SELECT 
+            username,
+            total_sessions,
+            total_queries
+        FROM user_statistics
+        ORDER BY total_queries DESC
+        LIMIT 10
+    """
+    user_activity = cached_query(query)
+    
+    if user_activity:
+        df = pd.DataFrame.from_records(user_activity, columns=('username', 'total_sessions', 'total_queries'))
+        
+        fig = go.Figure()
+        fig.add_trace(go.Bar(
+            name='會話數',
+            x=df['username'],
+            y=df['total_sessions'],
+            marker_color='lightblue'
+        ))
+        fig.add_trace(go.Bar(
+            name='查詢數',
+            x=df['username'],
+            y=df['total_queries'],
+            marker_color='salmon'
+        ))
+        
+        fig.update_layout(
+            title='Top 10 活躍使用者',
+            xaxis_title='使用者',
+            yaxis_title='數量',
+            barmode='group'
+        )
+        st.plotly_chart(fig, width='stretch', key='dash_user_activity')
+    else:
+        st.info("暫無數據")
+
+@st.fragment(run_every=60)
+def render_msg_distribution():
+    """訊息類型分布"""
+    query = """
+        SELECT 
+            role,
+            COUNT(*) as count
+        FROM messages
+        GROUP BY role
+    """
+    msg_dist = cached_query(query)
+    
+    if msg_dist:
+        df = pd.DataFrame.from_records(msg_dist, columns=('role', 'count'))
+        
+        fig = px.pie(
+            df,
+            values='count',
+            names='role',
+            title='訊息類型分布',
+            hole=0.4
+        )
+        st.plotly_chart(fig, width='stretch', key='dash_msg_distribution')
+    else:
+        st.info("暫無數據")
+
 # ===== 頁面 1: 儀表板 =====
 if page == "📊 儀表板":
     st.header("📊 系統儀表板")
@@ -93,7 +452,7 @@ if page == "📊 儀表板":
         st.metric(
             "💭 總訊息數",
             stats['total_messages'],
-            help="所有發送的訊息數量"
+            help="所有發送的訊息數量 (估計值)"
         )
     
     with col4:
@@ -110,52 +469,10 @@ if page == "📊 儀表板":
     col1, col2 = st.columns(2)
     
     with col1:
-        st.subheader("🕐 最近會話")
-        query = """
-            SELECT 
-                session_id,
-                session_name,
-                username,
-                session_start,
-                total_messages,
-                is_active
-            FROM session_summary
-            ORDER BY session_start DESC
-            LIMIT 10
-        """
-        recent_sessions = db.execute_query(query)
-        
-        if recent_sessions:
-            df = pd.DataFrame(recent_sessions)
-            df['session_start'] = pd.to_datetime(df['session_start'])
-            df['狀態'] = df['is_active'].apply(lambda x: '🟢 活躍' if x else '⚪ 結束')
-            
-            display_df = df[['session_name', 'username', 'total_messages', '狀態', 'session_start']]
-            display_df.columns = ['會話名稱', '使用者', '訊息數', '狀態', '開始時間']
-            st.dataframe(display_df, width='stretch', hide_index=True)
-        else:
-            st.info("尚無會話記錄")
+        render_recent_sessions()
     
     with col2:
-        st.subheader("⚠️ 最近警告")
-        query = """
-            SELECT 
-                warning_type,
-                warning_message,
-                created_at
-            FROM security_warnings
-            ORDER BY created_at DESC
-            LIMIT 10
-        """
-        recent_warnings = db.execute_query(query)
-        
-        if recent_warnings:
-            df = pd.DataFrame(recent_warnings)
-            df['created_at'] = pd.to_datetime(df['created_at'])
-            df.columns = ['類型', '訊息', '時間']
-            st.dataframe(df, width='stretch', hide_index=True)
-        else:
-            st.success("✅ 無安全警告")
+        render_recent_warnings()
     
     st.divider()
     
@@ -165,98 +482,13 @@ if page == "📊 儀表板":
     tab1, tab2, tab3 = st.tabs(["會話趨勢", "使用者活躍度", "訊息分布"])
     
     with tab1:
-        # 每日會話數趨勢
-        query = """
-            SELECT 
-                DATE(session_start) as date,
-                COUNT(*) as session_count
-            FROM sessions
-            WHERE session_start >= CURRENT_DATE - INTERVAL '30 days'
-            GROUP BY DATE(session_start)
-            ORDER BY date
-        """
-        trend_data = db.execute_query(query)
-        
-        if trend_data:
-            df = pd.DataFrame(trend_data)
-            df['date'] = pd.to_datetime(df['date'])
-            
-            fig = px.line(
-                df, 
-                x='date', 
-                y='session_count',
-                title='每日會話數 (最近30天)',
-                labels={'date': '日期', 'session_count': '會話數'}
-            )
-            fig.update_traces(mode='lines+markers')
-            st.plotly_chart(fig, width='stretch')
-        else:
-            st.info("暫無數據")
+        render_session_trend()
     
     with tab2:
-        # 使用者活躍度
-        query = """
-            SELECT 
-                username,
-                total_sessions,
-                total_queries
-            FROM user_statistics
-            ORDER BY total_queries DESC
-            LIMIT 10
-        """
-        user_activity = db.execute_query(query)
-        
-        if user_activity:
-            df = pd.DataFrame(user_activity)
-            
-            fig = go.Figure()
-            fig.add_trace(go.Bar(
-                name='會話數',
-                x=df['username'],
-                y=df['total_sessions'],
-                marker_color='lightblue'
-            ))
-            fig.add_trace(go.Bar(
-                name='查詢數',
-                x=df['username'],
-                y=df['total_queries'],
-                marker_color='salmon'
-            ))
-            
-            fig.update_layout(
-                title='Top 10 活躍使用者',
-                xaxis_title='使用者',
-                yaxis_title='數量',
-                barmode='group'
-            )
-            st.plotly_chart(fig, width='stretch')
-        else:
-            st.info("暫無數據")
+        render_user_activity()
     
     with tab3:
-        # 訊息類型分布
-        query = """
-            SELECT 
-                role,
-                COUNT(*) as count
-            FROM messages
-            GROUP BY role
-        """
-        msg_dist = db.execute_query(query)
-        
-        if msg_dist:
-            df = pd.DataFrame(msg_dist)
-            
-            fig = px.pie(
-                df,
-                values='count',
-                names='role',
-                title='訊息類型分布',
-                hole=0.4
-            )
-            st.plotly_chart(fig, width='stretch')
-        else:
-            st.info("暫無數據")
+        render_msg_distribution()
 
 # ===== 頁面 2: 使用者管理 =====
 elif page == "👥 使用者管理":
@@ -285,29 +517,29 @@ elif page == "👥 使用者管理":
         "註冊時間": "first_visit DESC"
     }
     
+    # ORDER BY 只能以白名單內的欄位組合插入查詢字串 (不在白名單時使用預設排序)
+    order_by = order_map.get(sort_by, order_map["最後訪問時間"])
+    
+    # 搜尋字串為空時不加上 ILIKE 條件,避免無意義的索引探查
+    where_clause = "WHERE username ILIKE %s" if search_username else ""
+    params = (f"%{search_username}%", limit) if search_username else (limit,)
+    
     query = f"""
         SELECT * FROM user_statistics
-        WHERE username ILIKE %s
-        ORDER BY {order_map[sort_by]}
-        LIMIT {limit}
+        {where_clause}
+        ORDER BY {order_by}
+        LIMIT %s
     """
     
-    users = db.execute_query(query, (f"%{search_username}%",))
+    users = db.execute_query(query, params)
     
     if users:
         st.success(f"找到 {len(users)} 位使用者")
         
-        df = pd.DataFrame(users)
-        df['first_visit'] = pd.to_datetime(df['first_visit']).dt.strftime('%Y-%m-%d %H:%M')
-        df['last_visit'] = pd.to_datetime(df['last_visit']).dt.strftime('%Y-%m-%d %H:%M')
+        df = pd.DataFrame.from_records(users, columns=USER_COLUMNS)
         
         # 顯示資料表
-        display_df = df[[
-            'user_id', 'username', 'ip_address', 
-            'total_sessions', 'total_queries', 'active_sessions',
-            'total_warnings', 'first_visit', 'last_visit'
-        ]]
-        
+        display_df = df.copy()
         display_df.columns = [
             'ID', '使用者名稱', 'IP位址',
             '總會話', '總查詢', '活躍會話',
@@ -324,6 +556,8 @@ elif page == "👥 使用者管理":
                 "總查詢": st.column_config.NumberColumn(format="%d"),
                 "活躍會話": st.column_config.NumberColumn(format="%d"),
                 "警告數": st.column_config.NumberColumn(format="%d"),
+                "首次訪問": DATETIME_COLUMN,
+                "最後訪問": DATETIME_COLUMN,
             }
         )
         
@@ -352,22 +586,21 @@ elif page == "👥 使用者管理":
             
             # 該使用者的會話列表
             st.markdown("**會話列表:**")
-            sessions = db.get_user_sessions(selected_user_id)
+            sessions = db.get_sessions_for_users([selected_user_id])
             
             if sessions:
-                sessions_df = pd.DataFrame(sessions)
-                sessions_df['session_start'] = pd.to_datetime(sessions_df['session_start']).dt.strftime('%Y-%m-%d %H:%M')
-                
-                display_sessions = sessions_df[[
-                    'session_id', 'session_name', 'total_messages',
-                    'warning_count', 'session_start', 'is_active'
-                ]]
-                display_sessions.columns = [
+                sessions_df = pd.DataFrame.from_records(sessions, columns=USER_SESSION_COLUMNS)
+                sessions_df.columns = [
                     '會話ID', '會話名稱', '訊息數', 
                     '警告數', '開始時間', '是否活躍'
                 ]
                 
-                st.dataframe(display_sessions, width='stretch', hide_index=True)
+                st.dataframe(
+                    sessions_df,
+                    width='stretch',
+                    hide_index=True,
+                    column_config={"開始時間": DATETIME_COLUMN}
+                )
     else:
         st.info("未找到符合條件的使用者")
 
@@ -409,8 +642,13 @@ elif page == "💬 會話管理":
         conditions.append("username ILIKE %s")
         params.append(f"%{filter_user}%")
     
-    conditions.append("DATE(session_start) BETWEEN %s AND %s")
-    params.extend([date_from, date_to])
+    # 結束日期為今天 (預設值) 時上限恆成立,只保留可使用索引的下限條件
+    if date_to >= datetime.now().date():
+        conditions.append("session_start >= %s")
+        params.append(date_from)
+    else:
+        conditions.append("session_start >= %s AND session_start < %s::date + 1")
+        params.extend([date_from, date_to])
     
     where_clause = " AND ".join(conditions) if conditions else "1=1"
     
@@ -425,23 +663,17 @@ elif page == "💬 會話管理":
     if sessions:
         st.success(f"找到 {len(sessions)} 個會話")
         
-        df = pd.DataFrame(sessions)
-        df['session_start'] = pd.to_datetime(df['session_start']).dt.strftime('%Y-%m-%d %H:%M')
-        df['狀態'] = df['is_active'].apply(lambda x: '🟢 活躍' if x else '⚪ 結束')
-        
-        display_df = df[[
-            'session_id', 'session_name', 'username',
-            'knowledge_base', 'total_messages', 'warning_count',
-            '狀態', 'session_start'
-        ]]
+        df = pd.DataFrame.from_records(sessions, columns=SESSION_COLUMNS)
         
+        display_df = df.copy()
+        display_df['is_active'] = display_df['is_active'].eq(True).map(ACTIVE_LABELS)
         display_df.columns = [
             '會話ID', '會話名稱', '使用者',
             '知識庫', '訊息數', '警告數',
             '狀態', '開始時間'
         ]
         
-        st.dataframe(display_df, width='stretch', hide_index=True)
+        st.dataframe(display_df, width='stretch', hide_index=True, column_config={"開始時間": DATETIME_COLUMN})
         
         # 會話詳情
         st.divider()
@@ -455,24 +687,31 @@ elif page == "💬 會話管理":
         
         if selected_session:
             # 顯示會話訊息
-            messages = db.get_session_messages(selected_session)
-            
-            st.markdown(f"**訊息記錄 ({len(messages)} 則):**")
+            # 逐批讀取訊息,筆數在讀取完畢後才填入標題
+            messages_header = st.empty()
+            message_count = 0
             
-            for msg in messages:
-                role_icon = "👤" if msg['role'] == 'user' else "🤖"
-                role_color = "blue" if msg['role'] == 'user' else "green"
-                
-                with st.expander(
-                    f"{role_icon} {msg['role'].upper()} - {msg['created_at'].strftime('%Y-%m-%d %H:%M:%S')}"
-                ):
-                    st.markdown(f":{role_color}[{msg['content']}]")
-                    
-                    if msg['has_chunks']:
-                        st.caption(f"📊 檢索到 {msg['chunk_count']} 個區塊")
+            try:
+                for msg in db.iter_session_messages(selected_session):
+                    message_count += 1
+                    role_icon = "👤" if msg['role'] == 'user' else "🤖"
+                    role_color = "blue" if msg['role'] == 'user' else "green"
                     
-                    if msg['tokens_used']:
-                        st.caption(f"🎫 使用 {msg['tokens_used']} tokens")
+                    with st.expander(
+                        f"{role_icon} {msg['role'].upper()} - {msg['created_at'].strftime('%Y-%m-%d %H:%M:%S')}"
+                    ):
+                        st.markdown(f":{role_color}[{msg['content']}]")
+                        
+                        if msg['has_chunks']:
+                            st.caption(f"📊 檢索到 {msg['chunk_count']} 個區塊")
+                        
+                        if msg['tokens_used']:
+                            st.caption(f"🎫 使用 {msg['tokens_used']} tokens")
+                
+            except Exception:
+                st.error("❌ 讀取訊息時發生錯誤,以下列表可能不完整")
+            
+            messages_header.markdown(f"**訊息記錄 ({message_count} 則):**")
     else:
         st.info("未找到符合條件的會話")
 
@@ -493,17 +732,27 @@ elif page == "💭 訊息查詢":
         )
     
     with col3:
-        limit = st.number_input("顯示數量", 10, 500, 100)
+        limit = st.number_input("每頁筆數", 10, 500, PAGE_SIZE)
     
-    # 建立查詢
-    conditions = ["content ILIKE %s"]
-    params = [f"%{search_content}%"]
+    # 建立查詢 (搜尋字串為空時不加上 ILIKE 條件)
+    conditions = []
+    params = []
+    
+    if search_content:
+        conditions.append("content ILIKE %s")
+        params.append(f"%{search_content}%")
     
     if filter_role != "全部":
         conditions.append("role = %s")
         params.append(filter_role)
     
-    where_clause = " AND ".join(conditions)
+    cursor = get_page_cursor("messages", (search_content, filter_role, limit))
+    if cursor:
+        conditions.append("(m.created_at, m.message_id) < (%s, %s)")
+        params.extend(cursor)
+    
+    params.append(limit)
+    where_clause = " AND ".join(conditions) if conditions else "1=1"
     
     query = f"""
         SELECT 
@@ -514,22 +763,36 @@ elif page == "💭 訊息查詢":
         JOIN sessions s ON m.session_id = s.session_id
         JOIN users u ON s.user_id = u.user_id
         WHERE {where_clause}
-        ORDER BY m.created_at DESC
-        LIMIT {limit}
+        ORDER BY m.created_at DESC, m.message_id DESC
+        LIMIT %s
     """
     
+    # 結果已由 LIMIT 限制筆數,以一般查詢一次取回
     messages = db.execute_query(query, tuple(params))
     
     if messages:
-        st.success(f"找到 {len(messages)} 則訊息")
+        st.success(f"本頁 {len(messages)} 則訊息,點選列查看完整內容")
         
-        for msg in messages:
+        df = pd.DataFrame.from_records(messages, columns=MESSAGE_COLUMNS)
+        df.columns = ['時間', '使用者', '會話名稱', '類型', '內容', '區塊數', 'Tokens']
+        event = st.dataframe(
+            df,
+            width='stretch',
+            hide_index=True,
+            key='msg_table',
+            on_select='rerun',
+            selection_mode='single-row',
+            column_config={"時間": DATETIME_COLUMN}
+        )
+        
+        # 選取訊息的詳情
+        msg = get_selected_row(event, messages)
+        if msg:
             role_icon = {"user": "👤", "assistant": "🤖", "system": "⚙️"}.get(msg['role'], "💭")
             role_color = {"user": "blue", "assistant": "green", "system": "orange"}.get(msg['role'], "gray")
             
-            with st.expander(
-                f"{role_icon} {msg['username']} - {msg['session_name']} ({msg['created_at'].strftime('%Y-%m-%d %H:%M')})"
-            ):
+            with st.container(border=True):
+                st.markdown(f"**{role_icon} {msg['username']} - {msg['session_name']} ({msg['created_at'].strftime('%Y-%m-%d %H:%M')})**")
                 st.markdown(f":{role_color}[{msg['content']}]")
                 
                 col1, col2, col3, col4 = st.columns(4)
@@ -545,6 +808,8 @@ elif page == "💭 訊息查詢":
                         st.caption(f"🎫 {msg['tokens_used']} tokens")
     else:
         st.info("未找到符合條件的訊息")
+    
+    render_page_nav("messages", len(messages or []), messages[-1] if messages else None, 'message_id', limit)
 
 # ===== 頁面 5: 檢索記錄 =====
 elif page == "🔍 檢索記錄":
@@ -566,7 +831,22 @@ elif page == "🔍 檢索記錄":
         search_source = st.text_input("🔍 搜尋來源文件", "")
     
     with col2:
-        limit = st.number_input("顯示數量", 10, 200, 50)
+        limit = st.number_input("每頁筆數", 10, 200, PAGE_SIZE)
+    
+    conditions = []
+    params = []
+    
+    if search_source:
+        conditions.append("rc.source_document ILIKE %s")
+        params.append(f"%{search_source}%")
+    
+    cursor = get_page_cursor("chunks", (search_source, limit))
+    if cursor:
+        conditions.append("(rc.created_at, rc.chunk_id) < (%s, %s)")
+        params.extend(cursor)
+    
+    params.append(limit)
+    where_clause = " AND ".join(conditions) if conditions else "1=1"
     
     query = f"""
         SELECT 
@@ -579,46 +859,74 @@ elif page == "🔍 檢索記錄":
         JOIN messages m ON rc.message_id = m.message_id
         JOIN sessions s ON m.session_id = s.session_id
         JOIN users u ON s.user_id = u.user_id
-        WHERE rc.source_document ILIKE %s
-        ORDER BY rc.created_at DESC
-        LIMIT {limit}
+        WHERE {where_clause}
+        ORDER BY rc.created_at DESC, rc.chunk_id DESC
+        LIMIT %s
     """
     
-    chunks = db.execute_query(query, (f"%{search_source}%",))
+    chunks = db.execute_query(query, tuple(params))
     
     if chunks:
-        st.success(f"找到 {len(chunks)} 個檢索區塊")
+        st.success(f"本頁 {len(chunks)} 個檢索區塊,點選列查看檢索內容")
+        
+        df = pd.DataFrame.from_records(chunks, columns=CHUNK_COLUMNS)
+        df.columns = ['時間', '來源文件', '使用者', '會話名稱', '區塊順序']
+        event = st.dataframe(
+            df,
+            width='stretch',
+            hide_index=True,
+            key='chunk_table',
+            on_select='rerun',
+            selection_mode='single-row',
+            column_config={"時間": DATETIME_COLUMN}
+        )
         
-        for chunk in chunks:
-            with st.expander(
-                f"📄 {chunk['source_document']} - {chunk['username']} ({chunk['created_at'].strftime('%Y-%m-%d %H:%M')})"
-            ):
+        # 選取區塊的詳情
+        chunk = get_selected_row(event, chunks)
+        if chunk:
+            with st.container(border=True):
+                st.markdown(f"**📄 {chunk['source_document']} - {chunk['username']} ({chunk['created_at'].strftime('%Y-%m-%d %H:%M')})**")
                 st.markdown(f"**原始查詢:** {chunk['query_content'][:100]}...")
                 st.markdown("**檢索內容:**")
-                st.text_area(
-                    "chunk_text",
-                    value=chunk['chunk_text'],
-                    height=150,
-                    disabled=True,
-                    label_visibility="collapsed",
-                    key=f"chunk_{chunk['chunk_id']}"
-                )
+                
+                # 預設只顯示前段內容,按下「顯示更多」後才輸出全文
+                chunk_text = chunk['chunk_text'] or ""
+                full_key = f"full_chunk_{chunk['chunk_id']}"
+                if len(chunk_text) > CHUNK_PREVIEW_CHARS and not st.session_state.get(full_key):
+                    st.code(chunk_text[:CHUNK_PREVIEW_CHARS] + "…", language='text', wrap_lines=True)
+                    if st.button("顯示更多", key=f"more_{full_key}"):
+                        st.session_state[full_key] = True
+                        st.rerun()
+                else:
+                    st.code(chunk_text, language='text', wrap_lines=True)
                 st.caption(f"區塊順序: {chunk['chunk_order']}")
     else:
         st.info("未找到檢索記錄")
+    
+    render_page_nav("chunks", len(chunks or []), chunks[-1] if chunks else None, 'chunk_id', limit)
 
 # ===== 頁面 6: 引用來源 =====
 elif page == "📖 引用來源":
     st.header("📖 引用來源")
     
-    # 統計
-    query = "SELECT COUNT(*) as total FROM citations"
-    result = db.execute_query(query)
-    total_citations = result[0]['total'] if result else 0
-    
-    query = "SELECT COUNT(DISTINCT document_name) as total FROM citations"
-    result = db.execute_query(query)
-    unique_docs = result[0]['total'] if result else 0
+    # 統計與最常被引用的文件 (單次查詢,總數以視窗函數計算)
+    query = """
+        SELECT 
+            document_name,
+            citation_count,
+            CAST(SUM(citation_count) OVER () AS BIGINT) as total_citations,
+            COUNT(document_name) OVER () as unique_docs
+        FROM (
+            SELECT document_name, COUNT(*) as citation_count
+            FROM citations
+            GROUP BY document_name
+        ) per_doc
+        ORDER BY citation_count DESC
+        LIMIT 20
+    """
+    top_citations = cached_query(query)
+    total_citations = top_citations[0]['total_citations'] if top_citations else 0
+    unique_docs = top_citations[0]['unique_docs'] if top_citations else 0
     
     col1, col2 = st.columns(2)
     with col1:
@@ -631,20 +939,8 @@ elif page == "📖 引用來源":
     # 最常被引用的文件
     st.subheader("📊 最常被引用的文件")
     
-    query = """
-        SELECT 
-            document_name,
-            COUNT(*) as citation_count
-        FROM citations
-        GROUP BY document_name
-        ORDER BY citation_count DESC
-        LIMIT 20
-    """
-    
-    top_citations = db.execute_query(query)
-    
     if top_citations:
-        df = pd.DataFrame(top_citations)
+        df = pd.DataFrame.from_records(top_citations, columns=('document_name', 'citation_count'))
         
         fig = px.bar(
             df,
@@ -654,42 +950,45 @@ elif page == "📖 引用來源":
             title='Top 20 最常引用文件',
             labels={'document_name': '文件名稱', 'citation_count': '引用次數'}
         )
-        st.plotly_chart(fig, width='stretch')
+        st.plotly_chart(fig, width='stretch', key='citation_top_docs')
         
         # 詳細列表
         st.subheader("📋 引用詳細記錄")
         
-        query = """
+        cursor = get_page_cursor("citations")
+        keyset = "WHERE (c.created_at, c.citation_id) < (%s, %s)" if cursor else ""
+        
+        query = f"""
             SELECT 
-                c.*,
-                m.content as message_content,
+                c.document_name,
+                c.chunk_reference,
+                u.username,
                 s.session_name,
-                u.username
+                c.citation_order,
+                c.created_at,
+                c.citation_id
             FROM citations c
             JOIN messages m ON c.message_id = m.message_id
             JOIN sessions s ON m.session_id = s.session_id
             JOIN users u ON s.user_id = u.user_id
-            ORDER BY c.created_at DESC
-            LIMIT 100
+            {keyset}
+            ORDER BY c.created_at DESC, c.citation_id DESC
+            LIMIT %s
         """
         
-        citations = db.execute_query(query)
+        citations = cached_arrow_query(query, (*(cursor or ()), PAGE_SIZE))
+        row_count = citations.num_rows if citations is not None else 0
         
-        if citations:
-            df = pd.DataFrame(citations)
-            df['created_at'] = pd.to_datetime(df['created_at']).dt.strftime('%Y-%m-%d %H:%M')
-            
-            display_df = df[[
-                'document_name', 'chunk_reference', 'username',
-                'session_name', 'citation_order', 'created_at'
-            ]]
-            
-            display_df.columns = [
+        if row_count:
+            table = citations.select(list(CITATION_COLUMNS)).rename_columns([
                 '文件名稱', '區塊參照', '使用者',
                 '會話名稱', '順序', '時間'
-            ]
+            ])
             
-            st.dataframe(display_df, width='stretch', hide_index=True)
+            st.dataframe(table, width='stretch', hide_index=True, column_config={"時間": DATETIME_COLUMN})
+        
+        last_citation = citations.slice(row_count - 1).to_pylist()[0] if row_count else None
+        render_page_nav("citations", row_count, last_citation, 'citation_id')
     else:
         st.info("暫無引用記錄")
 
@@ -697,20 +996,18 @@ elif page == "📖 引用來源":
 elif page == "⚠️ 安全警告":
     st.header("⚠️ 安全警告")
     
-    # 統計
-    query = "SELECT COUNT(*) as total FROM security_warnings"
-    result = db.execute_query(query)
-    total_warnings = result[0]['total'] if result else 0
-    
+    # 統計 (各類型數量與總數在同一次查詢取得)
     query = """
         SELECT 
             warning_type,
-            COUNT(*) as count
+            COUNT(*) as count,
+            CAST(SUM(COUNT(*)) OVER () AS BIGINT) as total
         FROM security_warnings
         GROUP BY warning_type
         ORDER BY count DESC
     """
-    warning_types = db.execute_query(query)
+    warning_types = cached_query(query)
+    total_warnings = warning_types[0]['total'] if warning_types else 0
     
     col1, col2 = st.columns([1, 2])
     
@@ -724,21 +1021,24 @@ elif page == "⚠️ 安全警告":
     
     with col2:
         if warning_types:
-            df = pd.DataFrame(warning_types)
+            df = pd.DataFrame.from_records(warning_types, columns=('warning_type', 'count'))
             fig = px.pie(
                 df,
                 values='count',
                 names='warning_type',
                 title='警告類型分布'
             )
-            st.plotly_chart(fig, width='stretch')
+            st.plotly_chart(fig, width='stretch', key='warning_types')
     
     st.divider()
     
     # 最近警告
     st.subheader("🕐 最近警告記錄")
     
-    query = """
+    cursor = get_page_cursor("warnings")
+    keyset = "WHERE (sw.created_at, sw.warning_id) < (%s, %s)" if cursor else ""
+    
+    query = f"""
         SELECT 
             sw.*,
             s.session_name,
@@ -746,31 +1046,54 @@ elif page == "⚠️ 安全警告":
         FROM security_warnings sw
         JOIN sessions s ON sw.session_id = s.session_id
         JOIN users u ON s.user_id = u.user_id
-        ORDER BY sw.created_at DESC
-        LIMIT 100
+        {keyset}
+        ORDER BY sw.created_at DESC, sw.warning_id DESC
+        LIMIT %s
     """
     
-    warnings = db.execute_query(query)
+    warnings = cached_query(query, (*(cursor or ()), PAGE_SIZE))
     
     if warnings:
-        for warning in warnings:
+        df = pd.DataFrame.from_records(warnings, columns=WARNING_COLUMNS)
+        df.columns = ['時間', '類型', '使用者', '會話名稱', '警告訊息']
+        
+        # 越獄類警告標紅色,其餘標橘色 (整欄一次計算)
+        severity_colors = df['類型'].str.contains('越獄', na=False).map({True: 'color: red', False: 'color: orange'})
+        styled_df = df.style.apply(lambda column: severity_colors, subset=['類型', '警告訊息'])
+        
+        event = st.dataframe(
+            styled_df,
+            width='stretch',
+            hide_index=True,
+            key='warn_table',
+            on_select='rerun',
+            selection_mode='single-row',
+            column_config={"時間": DATETIME_COLUMN}
+        )
+        
+        # 選取警告的詳情
+        warning = get_selected_row(event, warnings)
+        if warning:
             severity_color = "red" if "越獄" in warning['warning_type'] else "orange"
             
-            with st.expander(
-                f"⚠️ {warning['warning_type']} - {warning['username']} ({warning['created_at'].strftime('%Y-%m-%d %H:%M')})",
-                expanded=False
-            ):
+            with st.container(border=True):
+                st.markdown(f"**⚠️ {warning['warning_type']} - {warning['username']} ({warning['created_at'].strftime('%Y-%m-%d %H:%M')})**")
                 st.markdown(f":{severity_color}[{warning['warning_message']}]")
                 st.markdown(f"**原始查詢:** {warning['query_text']}")
                 st.caption(f"會話: {warning['session_name']}")
     else:
         st.success("✅ 沒有安全警告記錄")
+    
+    render_page_nav("warnings", len(warnings or []), warnings[-1] if warnings else None, 'warning_id')
 
 # ===== 頁面 8: 會話設定 =====
 elif page == "⚙️ 會話設定":
     st.header("⚙️ 會話設定")
     
-    query = """
+    cursor = get_page_cursor("settings")
+    keyset = "WHERE (ss.created_at, ss.setting_id) < (%s, %s)" if cursor else ""
+    
+    query = f"""
         SELECT 
             ss.*,
             s.session_name,
@@ -778,19 +1101,33 @@ elif page == "⚙️ 會話設定":
         FROM session_settings ss
         JOIN sessions s ON ss.session_id = s.session_id
         JOIN users u ON s.user_id = u.user_id
-        ORDER BY ss.created_at DESC
-        LIMIT 50
+        {keyset}
+        ORDER BY ss.created_at DESC, ss.setting_id DESC
+        LIMIT %s
     """
     
-    settings = db.execute_query(query)
+    settings = db.execute_query(query, (*(cursor or ()), PAGE_SIZE))
     
     if settings:
-        st.success(f"找到 {len(settings)} 個會話設定記錄")
+        st.success(f"本頁 {len(settings)} 個會話設定記錄,點選列查看系統提示詞")
+        
+        df = pd.DataFrame.from_records(settings, columns=SETTING_COLUMNS)
+        df.columns = ['時間', '會話名稱', '使用者', '模型', '中繼資料篩選', '安全防護']
+        event = st.dataframe(
+            df,
+            width='stretch',
+            hide_index=True,
+            key='setting_table',
+            on_select='rerun',
+            selection_mode='single-row',
+            column_config={"時間": DATETIME_COLUMN}
+        )
         
-        for setting in settings:
-            with st.expander(
-                f"⚙️ {setting['session_name']} - {setting['username']} ({setting['created_at'].strftime('%Y-%m-%d %H:%M')})"
-            ):
+        # 選取設定的詳情
+        setting = get_selected_row(event, settings)
+        if setting:
+            with st.container(border=True):
+                st.markdown(f"**⚙️ {setting['session_name']} - {setting['username']} ({setting['created_at'].strftime('%Y-%m-%d %H:%M')})**")
                 col1, col2, col3 = st.columns(3)
                 
                 with col1:
@@ -809,6 +1146,8 @@ elif page == "⚙️ 會話設定":
                 st.code(setting['system_prompt'][:500] + "..." if len(setting['system_prompt']) > 500 else setting['system_prompt'])
     else:
         st.info("暫無會話設定記錄")
+    
+    render_page_nav("settings", len(settings or []), settings[-1] if settings else None, 'setting_id')
 
 # ===== 頁面 9: 統計分析 =====
 elif page == "📈 統計分析":
@@ -837,45 +1176,50 @@ elif page == "📈 統計分析":
     with tab1:
         st.subheader("使用趨勢分析")
         
-        # 每日統計
+        # 每日統計 (讀取每日會話彙總)
+        rollup = refresh_session_rollups()
+        show_rollup_caption(rollup)
         query = """
             SELECT 
-                DATE(session_start) as date,
-                COUNT(DISTINCT session_id) as sessions,
-                COUNT(DISTINCT s.user_id) as users,
-                SUM(total_messages) as messages
-            FROM sessions s
-            WHERE DATE(session_start) BETWEEN %s AND %s
-            GROUP BY DATE(session_start)
+                date,
+                session_count as sessions,
+                user_count as users,
+                message_count as messages
+            FROM session_daily_counts
+            WHERE date BETWEEN $1 AND $2
             ORDER BY date
         """
         
-        trend = db.execute_query(query, (date_from, date_to))
+        trend = cached_prepared(
+            'stats_daily_trend', query, (date_from, date_to), as_dict=False, rollup_version=rollup['refreshed_at']
+        )
         
         if trend:
-            df = pd.DataFrame(trend)
-            df['date'] = pd.to_datetime(df['date'])
+            df = pd.DataFrame.from_records(trend, columns=('date', 'sessions', 'users', 'messages'))
             
-            # 多線圖
+            # 多線圖 (以 WebGL 繪製,日期範圍拉長時不會產生大量 SVG 節點)
             fig = go.Figure()
             
-            fig.add_trace(go.Scatter(
-                x=df['date'],
-                y=df['sessions'],
+            x, y = downsample_series(df, 'date', 'sessions')
+            fig.add_trace(go.Scattergl(
+                x=x,
+                y=y,
                 name='會話數',
                 mode='lines+markers'
             ))
             
-            fig.add_trace(go.Scatter(
-                x=df['date'],
-                y=df['users'],
+            x, y = downsample_series(df, 'date', 'users')
+            fig.add_trace(go.Scattergl(
+                x=x,
+                y=y,
                 name='使用者數',
                 mode='lines+markers'
             ))
             
-            fig.add_trace(go.Scatter(
-                x=df['date'],
-                y=df['messages'],
+            x, y = downsample_series(df, 'date', 'messages')
+            fig.add_trace(go.Scattergl(
+                x=x,
+                y=y,
                 name='訊息數',
                 mode='lines+markers',
                 yaxis='y2'
@@ -893,7 +1237,7 @@ elif page == "📈 統計分析":
                 hovermode='x unified'
             )
             
-            st.plotly_chart(fig, width='stretch')
+            st.plotly_chart(fig, width='stretch', key='stats_trend')
             
             # 數據表
             st.dataframe(df, width='stretch', hide_index=True)
@@ -903,53 +1247,34 @@ elif page == "📈 統計分析":
     with tab2:
         st.subheader("使用者行為分析")
         
-        # 使用者活躍度分布
+        # 使用者活躍度分布 (區間只計算一次,依區間序號排序)
         query = """
             SELECT 
-                CASE 
-                    WHEN total_queries < 10 THEN '1-9次'
-                    WHEN total_queries < 50 THEN '10-49次'
-                    WHEN total_queries < 100 THEN '50-99次'
-                    ELSE '100+次'
-                END as query_range,
+                query_range,
                 COUNT(*) as user_count
-            FROM users
-            GROUP BY 
-                CASE 
-                    WHEN total_queries < 10 THEN '1-9次'
-                    WHEN total_queries < 50 THEN '10-49次'
-                    WHEN total_queries < 100 THEN '50-99次'
-                    ELSE '100+次'
-                END
-            ORDER BY 
-                CASE 
-                    WHEN CASE 
+            FROM (
+                SELECT 
+                    CASE 
+                        WHEN total_queries < 10 THEN 1
+                        WHEN total_queries < 50 THEN 2
+                        WHEN total_queries < 100 THEN 3
+                        ELSE 4
+                    END as range_order,
+                    CASE 
                         WHEN total_queries < 10 THEN '1-9次'
                         WHEN total_queries < 50 THEN '10-49次'
                         WHEN total_queries < 100 THEN '50-99次'
                         ELSE '100+次'
-                    END = '1-9次' THEN 1
-                    WHEN CASE 
-                        WHEN total_queries < 10 THEN '1-9次'
-                        WHEN total_queries < 50 THEN '10-49次'
-                        WHEN total_queries < 100 THEN '50-99次'
-                        ELSE '100+次'
-                    END = '10-49次' THEN 2
-                    WHEN CASE 
-                        WHEN total_queries < 10 THEN '1-9次'
-                        WHEN total_queries < 50 THEN '10-49次'
-                        WHEN total_queries < 100 THEN '50-99次'
-                        ELSE '100+次'
-                    END = '50-99次' THEN 3
-                    ELSE 4
-                END
+                    END as query_range
+                FROM users
+            ) buckets
+            GROUP BY query_range, range_order
+            ORDER BY range_order
         """
         
-        user_dist = db.execute_query(query)
+        df = cached_report_df(query)
         
-        if user_dist:
-            df = pd.DataFrame(user_dist)
-            
+        if df is not None and not df.empty:
             fig = px.bar(
                 df,
                 x='query_range',
@@ -957,7 +1282,7 @@ elif page == "📈 統計分析":
                 title='使用者查詢次數分布',
                 labels={'query_range': '查詢次數範圍', 'user_count': '使用者數'}
             )
-            st.plotly_chart(fig, width='stretch')
+            st.plotly_chart(fig, width='stretch', key='stats_user_distribution')
         
         # Top 使用者
         st.markdown("**Top 20 活躍使用者:**")
@@ -974,171 +1299,143 @@ elif page == "📈 統計分析":
             LIMIT 20
         """
         
-        top_users = db.execute_query(query)
+        top_users = cached_arrow_query(query)
         
-        if top_users:
-            df = pd.DataFrame(top_users)
-            df['last_visit'] = pd.to_datetime(df['last_visit']).dt.strftime('%Y-%m-%d %H:%M')
-            df.columns = ['使用者', '總會話', '總查詢', '警告數', '最後訪問']
-            st.dataframe(df, width='stretch', hide_index=True)
+        if top_users is not None and top_users.num_rows:
+            table = top_users.rename_columns(['使用者', '總會話', '總查詢', '警告數', '最後訪問'])
+            st.dataframe(table, width='stretch', hide_index=True, column_config={"最後訪問": DATETIME_COLUMN})
     
     with tab3:
         st.subheader("時段分析")
         
-        # 每小時分布
+        # 每小時與星期分布共用一次查詢: 取回 (時段, 星期) 彙總 (最多 168 列),再分別加總
+        rollup = refresh_session_rollups()
+        show_rollup_caption(rollup)
         query = """
             SELECT 
-                EXTRACT(HOUR FROM session_start) as hour,
-                COUNT(*) as session_count
-            FROM sessions
-            WHERE DATE(session_start) BETWEEN %s AND %s
-            GROUP BY EXTRACT(HOUR FROM session_start)
-            ORDER BY hour
+                hour,
+                dow,
+                SUM(session_count)::bigint as session_count
+            FROM session_hourly_counts
+            WHERE date BETWEEN %s AND %s
+            GROUP BY hour, dow
         """
         
-        hourly = db.execute_query(query, (date_from, date_to))
+        df = cached_report_df(query, (date_from, date_to), rollup_version=rollup['refreshed_at'])
         
-        if hourly:
-            df = pd.DataFrame(hourly)
-            df['hour'] = df['hour'].astype(int)
+        if df is not None and not df.empty:
+            # 每小時分布
+            hourly = df.groupby('hour', as_index=False)['session_count'].sum()
+            hourly['hour'] = hourly['hour'].astype(int)
             
             fig = px.bar(
-                df,
+                hourly,
                 x='hour',
                 y='session_count',
                 title='每小時會話分布',
                 labels={'hour': '時段', 'session_count': '會話數'}
             )
-            st.plotly_chart(fig, width='stretch')
-        
-        # 星期分布
-        query = """
-            SELECT 
-                TO_CHAR(session_start, 'Day') as day_name,
-                EXTRACT(DOW FROM session_start) as day_num,
-                COUNT(*) as session_count
-            FROM sessions
-            WHERE DATE(session_start) BETWEEN %s AND %s
-            GROUP BY TO_CHAR(session_start, 'Day'), EXTRACT(DOW FROM session_start)
-            ORDER BY day_num
-        """
-        
-        weekly = db.execute_query(query, (date_from, date_to))
-        
-        if weekly:
-            df = pd.DataFrame(weekly)
+            st.plotly_chart(fig, width='stretch', key='stats_hourly')
+            
+            # 星期分布 (以整數 dow 分組,名稱在彙總後的 7 列上對應)
+            weekly = df.groupby('dow', as_index=False)['session_count'].sum()
+            weekly['day_name'] = weekly['dow'].astype(int).map(WEEKDAY_NAMES)
             
             fig = px.bar(
-                df,
+                weekly,
                 x='day_name',
                 y='session_count',
                 title='星期分布',
                 labels={'day_name': '星期', 'session_count': '會話數'}
             )
-            st.plotly_chart(fig, width='stretch')
+            st.plotly_chart(fig, width='stretch', key='stats_weekly')
     
     with tab4:
         st.subheader("綜合統計報表")
         
-        # 綜合統計
-        col1, col2, col3, col4 = st.columns(4)
-        
-        # 總會話數
+        # 綜合統計與詳細統計共用同一次查詢
+        # 日期條件使用半開區間 [開始日, 結束日+1),可直接使用 session_start / created_at 索引
+        # 各資料表分別彙總後再合併,避免多表 LEFT JOIN 造成列數倍增
+        # (不再有重複列,主鍵計數直接使用 COUNT(*);使用者可能有多個會話,仍需去重,
+        #  改寫為 SELECT DISTINCT 子查詢,讓規劃器可用 HashAggregate 而非 COUNT(DISTINCT) 的排序)
+        # 只有日期參數會變動,以預備陳述式執行,每個連線只解析與規劃一次
+        # COUNT 不會回傳 NULL,空區間的 AVG 以 COALESCE 補 0,結果可直接使用
         query = """
-            SELECT COUNT(*) as total 
-            FROM sessions 
-            WHERE DATE(session_start) BETWEEN %s AND %s
+            WITH s AS (
+                SELECT session_id, user_id, total_messages
+                FROM sessions
+                WHERE session_start >= $1 AND session_start < $2::date + 1
+            ),
+            m AS (
+                SELECT message_id, role
+                FROM messages
+                WHERE session_id IN (SELECT session_id FROM s)
+            ),
+            session_stats AS (
+                SELECT 
+                    COUNT(*) as total_sessions,
+                    (SELECT COUNT(*) FROM (SELECT DISTINCT user_id FROM s) u) as unique_users,
+                    ROUND(COALESCE(AVG(total_messages), 0), 2)::float as avg_messages_per_session
+                FROM s
+            ),
+            message_stats AS (
+                SELECT 
+                    COUNT(*) as total_messages,
+                    COUNT(*) FILTER (WHERE role = 'user') as user_messages,
+                    COUNT(*) FILTER (WHERE role = 'assistant') as ai_messages
+                FROM m
+            ),
+            chunk_stats AS (
+                SELECT COUNT(*) as total_chunks
+                FROM retrieval_chunks
+                WHERE message_id IN (SELECT message_id FROM m)
+            ),
+            citation_stats AS (
+                SELECT COUNT(*) as total_citations
+                FROM citations
+                WHERE message_id IN (SELECT message_id FROM m)
+            ),
+            warning_stats AS (
+                SELECT COUNT(*) as total_warnings
+                FROM security_warnings
+                WHERE session_id IN (SELECT session_id FROM s)
+            )
+            SELECT 
+                session_stats.*,
+                message_stats.*,
+                chunk_stats.*,
+                citation_stats.*,
+                warning_stats.*,
+                (SELECT COUNT(*) FROM security_warnings
+                 WHERE created_at >= $1 AND created_at < $2::date + 1) as period_warnings
+            FROM session_stats, message_stats, chunk_stats, citation_stats, warning_stats
         """
-        result = db.execute_query(query, (date_from, date_to))
-        with col1:
-            st.metric("總會話", result[0]['total'] if result else 0)
         
-        # 總訊息數
-        query = """
-            SELECT COUNT(*) as total 
-            FROM messages m
-            JOIN sessions s ON m.session_id = s.session_id
-            WHERE DATE(s.session_start) BETWEEN %s AND %s
-        """
-        result = db.execute_query(query, (date_from, date_to))
-        with col2:
-            st.metric("總訊息", result[0]['total'] if result else 0)
+        stats = cached_prepared('stats_report', query, (date_from, date_to))
+        stat = stats[0] if stats else {}
         
-        # 活躍使用者
-        query = """
-            SELECT COUNT(DISTINCT s.user_id) as total
-            FROM sessions s
-            WHERE DATE(s.session_start) BETWEEN %s AND %s
-        """
-        result = db.execute_query(query, (date_from, date_to))
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("總會話", stat.get('total_sessions', 0))
+        with col2:
+            st.metric("總訊息", stat.get('total_messages', 0))
         with col3:
-            st.metric("活躍使用者", result[0]['total'] if result else 0)
-        
-        # 安全警告
-        query = """
-            SELECT COUNT(*) as total
-            FROM security_warnings sw
-            WHERE DATE(sw.created_at) BETWEEN %s AND %s
-        """
-        result = db.execute_query(query, (date_from, date_to))
+            st.metric("活躍使用者", stat.get('unique_users', 0))
         with col4:
-            st.metric("安全警告", result[0]['total'] if result else 0)
+            st.metric("安全警告", stat.get('period_warnings', 0))
         
         st.divider()
         
         # 詳細統計表
         st.markdown("**詳細統計:**")
         
-        query = """
-            SELECT 
-                COUNT(DISTINCT s.session_id) as total_sessions,
-                COUNT(DISTINCT s.user_id) as unique_users,
-                COUNT(DISTINCT m.message_id) as total_messages,
-                COUNT(DISTINCT CASE WHEN m.role = 'user' THEN m.message_id END) as user_messages,
-                COUNT(DISTINCT CASE WHEN m.role = 'assistant' THEN m.message_id END) as ai_messages,
-                COUNT(DISTINCT rc.chunk_id) as total_chunks,
-                COUNT(DISTINCT c.citation_id) as total_citations,
-                COUNT(DISTINCT sw.warning_id) as total_warnings,
-                AVG(s.total_messages) as avg_messages_per_session
-            FROM sessions s
-            LEFT JOIN messages m ON s.session_id = m.session_id
-            LEFT JOIN retrieval_chunks rc ON m.message_id = rc.message_id
-            LEFT JOIN citations c ON m.message_id = c.message_id
-            LEFT JOIN security_warnings sw ON s.session_id = sw.session_id
-            WHERE DATE(s.session_start) BETWEEN %s AND %s
-        """
-        
-        stats = db.execute_query(query, (date_from, date_to))
-        
         if stats:
             stat = stats[0]
             
-            data = {
-                "指標": [
-                    "總會話數",
-                    "獨立使用者數",
-                    "總訊息數",
-                    "使用者訊息",
-                    "AI 回覆",
-                    "檢索區塊",
-                    "引用次數",
-                    "安全警告",
-                    "平均訊息/會話"
-                ],
-                "數值": [
-                    int(stat['total_sessions']) if stat['total_sessions'] else 0,
-                    int(stat['unique_users']) if stat['unique_users'] else 0,
-                    int(stat['total_messages']) if stat['total_messages'] else 0,
-                    int(stat['user_messages']) if stat['user_messages'] else 0,
-                    int(stat['ai_messages']) if stat['ai_messages'] else 0,
-                    int(stat['total_chunks']) if stat['total_chunks'] else 0,
-                    int(stat['total_citations']) if stat['total_citations'] else 0,
-                    int(stat['total_warnings']) if stat['total_warnings'] else 0,
-                    round(float(stat['avg_messages_per_session']), 2) if stat['avg_messages_per_session'] else 0.0
-                ]
-            }
-            
-            df = pd.DataFrame(data)
+            df = pd.DataFrame({
+                "指標": list(REPORT_METRICS.values()),
+                "數值": [stat[key] for key in REPORT_METRICS]
+            })
             st.dataframe(df, width='stretch', hide_index=True)
 
 # ===== 頁面 10: SQL 查詢 =====
@@ -1217,45 +1514,67 @@ LIMIT 10;
     with col2:
         clear_btn = st.button("🗑️ 清空")
         if clear_btn:
+            st.session_state.pop('sql_result', None)
             st.rerun()
     
     # 執行查詢
     if execute_btn and sql_query.strip():
-        # 安全檢查 - 只允許 SELECT 查詢
-        if not sql_query.strip().upper().startswith('SELECT'):
+        # 安全檢查 - 只允許 SELECT / WITH 查詢,並在唯讀交易中執行
+        if get_leading_keyword(sql_query) not in READ_ONLY_KEYWORDS:
             st.error("❌ 僅允許執行 SELECT 查詢")
         else:
             try:
+                # DataFrame 直接由游標建立,欄位保留資料庫驅動轉換後的型態 (時間、數值不經過 CSV 重新推測)
+                # 換行避免查詢結尾的 -- 註解吃掉外層的括號與 LIMIT
+                capped_query = f"SELECT * FROM (\n{sql_query.strip().rstrip(';')}\n) capped LIMIT {MAX_SQL_RESULT_ROWS}"
                 with st.spinner("執行中..."):
-                    result = db.execute_query(sql_query)
+                    df = db.query_df(capped_query, read_only=True)
                 
-                if result:
-                    st.success(f"✅ 查詢成功! 返回 {len(result)} 筆記錄")
-                    
-                    # 顯示結果
-                    df = pd.DataFrame(result)
-                    
-                    # 下載按鈕
-                    csv = df.to_csv(index=False).encode('utf-8-sig')
-                    st.download_button(
-                        label="📥 下載 CSV",
-                        data=csv,
-                        file_name=f"query_result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                        mime="text/csv"
-                    )
-                    
-                    # 顯示資料表
-                    st.dataframe(df, width='stretch')
-                    
-                    # 顯示資料型態資訊
-                    with st.expander("📊 資料型態資訊"):
-                        st.write(df.dtypes)
+                if df is None:
+                    st.session_state.pop('sql_result', None)
+                    st.error("❌ 查詢執行失敗,請檢查 SQL 語法")
+                    st.code(sql_query, language="sql")
                 else:
-                    st.info("查詢無返回結果")
+                    # 結果保存在 session_state,點擊下載等操作觸發重新執行時不必再查詢與解析
+                    # (下載資料加上 BOM 讓 Excel 以 UTF-8 開啟,只在查詢時組合一次)
+                    st.session_state['sql_result'] = {
+                        'query': sql_query,
+                        'df': df,
+                        'csv': df.to_csv(index=False).encode('utf-8-sig'),
+                        'file_name': f"query_result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+                    }
                     
             except Exception as e:
+                st.session_state.pop('sql_result', None)
                 st.error(f"❌ 查詢執行失敗: {str(e)}")
                 st.code(sql_query, language="sql")
+    
+    # 顯示最近一次的查詢結果 (查詢語句修改後不再顯示舊結果)
+    sql_result = st.session_state.get('sql_result')
+    if sql_result and sql_result['query'] == sql_query:
+        df = sql_result['df']
+        
+        if not df.empty:
+            st.success(f"✅ 查詢成功! 返回 {len(df)} 筆記錄")
+            if len(df) >= MAX_SQL_RESULT_ROWS:
+                st.info(f"結果已限制為前 {MAX_SQL_RESULT_ROWS} 筆,如需更多資料請自行加上條件或分批查詢")
+            
+            # 下載按鈕
+            st.download_button(
+                label="📥 下載 CSV",
+                data=sql_result['csv'],
+                file_name=sql_result['file_name'],
+                mime="text/csv"
+            )
+            
+            # 顯示資料表
+            st.dataframe(df, width='stretch')
+            
+            # 顯示資料型態資訊 (DataFrame 由游標建立,型態來自資料庫驅動的轉換結果)
+            with st.expander("📊 資料型態資訊"):
+                st.write(df.dtypes)
+        else:
+            st.info("查詢無返回結果")
 
 # 頁尾
 st.divider()
@@ -0,0 +1,16 @@
+import sys
+
+from db_manager import DatabaseManager
+
+# 建立聊天介面與資料庫檢視介面所需的索引與彙總視圖 (部署或升級時執行一次,需有建立 pg_trgm 擴充的權限)
+# 索引以 CONCURRENTLY 建立,可在聊天介面運作中執行
+with DatabaseManager() as db:
+    if not db.ping():
+        print("❌ 資料庫連線失敗")
+        sys.exit(1)
+    print("🔧 正在建立索引與彙總視圖...")
+    if db.migrate_viewer_objects():
+        print("✅ 資料庫遷移完成!")
+    else:
+        print("❌ 資料庫遷移失敗,請查看錯誤記錄")
+        sys.exit(1)
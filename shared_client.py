@@ -0,0 +1,13 @@
+import streamlit as st
+from google import genai
+import os
+
+# 初始化 Gemini 客戶端 (同一個 Streamlit 程序內的所有頁面共用)
+@st.cache_resource
+def get_client():
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        st.error("請設定 GEMINI_API_KEY 環境變數")
+        st.info("請在終端執行: export GEMINI_API_KEY='your-api-key'")
+        st.stop()
+    return genai.Client(api_key=api_key)
@@ -1,10 +1,14 @@
+import sys
+
 from db_manager import DatabaseManager
 
-db = DatabaseManager()
-if db.connect():
-    print("✅ 資料庫連線成功!")
-    stats = db.get_statistics()
-    print(f"統計資料: {stats}")
-    db.close()
-else:
-    print("❌ 資料庫連線失敗")
\ No newline at end of file
+# 預設只做單次 SELECT 1 健康檢查;加上 --stats 參數時才查詢統計資料
+with DatabaseManager() as db:
+    if db.ping():
+        print("✅ 資料庫連線成功!")
+        if '--stats' in sys.argv:
+            stats = db.get_statistics(approximate=True)
+            print(f"統計資料: {stats}")
+    else:
+        print("❌ 資料庫連線失敗")
+        sys.exit(1)
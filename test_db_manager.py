@@ -0,0 +1,44 @@
+import unittest
+
+from db_manager import DatabaseManager
+
+
+class RecordingCursor:
+    """記錄 copy_expert 呼叫內容的游標 (不需連線資料庫)"""
+    
+    def __init__(self):
+        self.copies = []
+    
+    def copy_expert(self, query, buffer):
+        self.copies.append((query, buffer.read()))
+
+
+class ExecuteCopyTest(unittest.TestCase):
+    
+    def test_large_chunk_batch_uses_copy_and_keeps_empty_text(self):
+        db = DatabaseManager()
+        cursor = RecordingCursor()
+        chunks = [{'source': f'doc{i}.pdf', 'text': ''} for i in range(DatabaseManager.COPY_THRESHOLD)]
+        
+        self.assertTrue(db.add_retrieval_chunks(7, chunks, cursor))
+        
+        self.assertEqual(len(cursor.copies), 1)
+        query, data = cursor.copies[0]
+        self.assertIn("COPY retrieval_chunks (message_id, source_document, chunk_text, chunk_order)", query)
+        lines = data.splitlines()
+        self.assertEqual(len(lines), DatabaseManager.COPY_THRESHOLD)
+        # 空字串必須加上引號,否則 COPY 會存成 NULL
+        self.assertEqual(lines[0], '7,"doc0.pdf","",1')
+        self.assertEqual(lines[-1], f'7,"doc{len(chunks) - 1}.pdf","",{len(chunks)}')
+    
+    def test_copy_escapes_quotes_and_newlines(self):
+        db = DatabaseManager()
+        cursor = RecordingCursor()
+        
+        self.assertTrue(db.execute_copy('t', ['a', 'b'], [(1, 'say "hi"\nbye')], cursor))
+        
+        self.assertEqual(cursor.copies[0][1], '1,"say ""hi""\nbye"\r\n')
+
+
+if __name__ == '__main__':
+    unittest.main()